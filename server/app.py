@@ -1,30 +1,37 @@
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, jsonify, request, send_from_directory, Response
 from flask import session as flask_session
 from flask_cors import CORS
 from langchain_openai.chat_models import ChatOpenAI
 from langchain_community.embeddings import OllamaEmbeddings
 from langchain_community.chat_models import ChatOllama
-from langchain_chroma import Chroma
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
 
 from flask_jwt_extended import create_access_token,get_jwt,get_jwt_identity, unset_jwt_cookies, jwt_required, JWTManager
 from datetime import timedelta, datetime
-from modal import db, File, DPIA, bcrypt, Template, Project, User, DPIA_File
+from modal import db, File, DPIA, bcrypt, Template, Project, User, DPIA_File, DPIA_Section
 from sqlalchemy.orm import sessionmaker
-from helper import check_path, clear_chat_embed, partition_process, DPIAPDFGenerator, create_template, create_chatData, split_text_into_chunks, expanded_response
+from helper import check_path, clear_chat_embed, delete_embeddings, move_to_trash, remove_paths, partition_process, DPIAPDFGenerator, create_template, KnowledgeBase, expanded_response, synthesise_response, token_counter, prompt_tokens, pack_context
 from celery import Celery
+from celery.signals import worker_process_init, worker_ready, task_failure, task_revoked, task_postrun
 from celery.result import AsyncResult
-from crewai import Agent, Task, Crew, Process
+from crewai import Agent
 
 import secrets, pdfplumber, math, psutil, GPUtil, fitz
 from dotenv import load_dotenv, set_key
-import os, json, subprocess, logging, time
+import os, json, subprocess, logging, time, redis, threading
 from werkzeug.utils import secure_filename
 import shutil
 import pdfplumber
 import pandas as pd
-from rerank import rerank_response
+from rerank import rerank_response, rerank_responses
+from hybrid import retrieve
+from stores import VectorStorePool
+from docstore import migrate_roots
+from scheduler import run_sections
+from events import TaskEvents, TokenStream
+from concurrent.futures import ThreadPoolExecutor
+from cache import IngestCache, SummaryCache, EmbeddingCache, CachedEmbeddings, AnswerCache, file_digest
 
 
 class AjaxFilter(logging.Filter):
@@ -65,8 +72,17 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///info.db'
 
-# Set up embedding models
-embeddings = OllamaEmbeddings(model="nomic-embed-text")
+# Set up embedding models, cached on disk so repeated texts and queries are only embedded once
+embeddings = CachedEmbeddings(OllamaEmbeddings(model="nomic-embed-text"),
+                              EmbeddingCache(os.path.join(BASE_DIR, "cache", "embedding.sqlite3"),
+                                             max_bytes=int(os.getenv("EMBEDDING_CACHE_MAX_MB", 1024)) * 1024 ** 2))
+# Open per-user summary collections, reused across requests and tasks, their loaded indexes take at most
+# VECTORSTORE_MEMORY_MB of memory per process, 0 for no limit
+vectorstores = VectorStorePool(BASE_DIR + "/vectorDB/", embeddings, memory_limit=int(os.getenv("VECTORSTORE_MEMORY_MB", 2048)) * 1024 ** 2)
+# Built-in knowledge base answering chat messages without a document, kept warm in every worker
+knowledge_base = KnowledgeBase(BASE_DIR, embeddings)
+# Move parent documents left by LocalFileStore into the SQLite stores once per process, stores are then opened directly
+migrate_roots([os.path.join(BASE_DIR, "vectorDB", "parentData"), os.path.join(BASE_DIR, "chatData", "parentData")])
 parser = StrOutputParser()
 
 db.init_app(app)
@@ -86,6 +102,40 @@ for fileName in ['UK ICO (Default).txt', 'NEW.txt']:
 load_dotenv()
 
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
+# number of documents partitioned side by side during ingestion
+PARTITION_WORKERS = int(os.getenv("PARTITION_WORKERS", 2))
+# documents longer than this many pages are partitioned and indexed in windows of this many pages
+PAGE_WINDOW = int(os.getenv("PAGE_WINDOW", 25))
+# number of DPIA sections written at the same time against the Ollama backend
+SECTION_CONCURRENCY = int(os.getenv("SECTION_CONCURRENCY", 2))
+# seconds a DPIA stays marked as being generated without a heartbeat from its task, a dead worker frees it after this
+DPIA_LEASE_TTL = int(os.getenv("DPIA_LEASE_TTL", 120))
+# event streams open at the same time, each one holds a request thread until its task finishes
+MAX_STREAMS = int(os.getenv("MAX_STREAMS", 16))
+# seconds a client has to open the event stream of a task it started
+STREAM_TOKEN_TTL = int(os.getenv("STREAM_TOKEN_TTL", 60))
+# how answers are built from the chunks of context: "refine" chains the chunks, "map_reduce" answers them
+# side by side and merges the partial answers, a task can override it with its 'synthesis' field
+SYNTHESIS_MODE = os.getenv("SYNTHESIS_MODE", "refine")
+# number of chunks answered at the same time in map_reduce mode
+SYNTHESIS_WORKERS = int(os.getenv("SYNTHESIS_WORKERS", 2))
+# how context is retrieved: "vector" similarity search, or "hybrid" fused vector and BM25 search
+# which hands only RETRIEVAL_CANDIDATES documents to the reranker, a task can override it with its 'retrieval' field
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "vector")
+RETRIEVAL_CANDIDATES = int(os.getenv("RETRIEVAL_CANDIDATES", 8))
+# documents of a DPIA are searched one by one, each keeps at least this many candidates
+FILE_QUOTA = int(os.getenv("FILE_QUOTA", 2))
+# content-addressed cache of ingestion output, shared by chats and projects of every user
+ingest_cache = IngestCache(os.path.join(BASE_DIR, "cache", "ingest.sqlite3"),
+                           max_bytes=int(os.getenv("INGEST_CACHE_MAX_MB", 2048)) * 1024 ** 2,
+                           max_age=int(os.getenv("INGEST_CACHE_MAX_DAYS", 30)) * 24 * 3600)
+summary_cache = SummaryCache(os.path.join(BASE_DIR, "cache", "summary.sqlite3"),
+                             max_bytes=int(os.getenv("SUMMARY_CACHE_MAX_MB", 512)) * 1024 ** 2)
+# chat answers reused for similar questions about the same document, cleared with the chat
+answer_cache = AnswerCache(os.path.join(BASE_DIR, "cache", "answer.sqlite3"),
+                           threshold=float(os.getenv("ANSWER_CACHE_THRESHOLD", 0.95)),
+                           ttl=int(os.getenv("ANSWER_CACHE_TTL_HOURS", 24)) * 3600,
+                           max_bytes=int(os.getenv("ANSWER_CACHE_MAX_MB", 256)) * 1024 ** 2)
 
 # generate unique secret key as an environment variable
 ENV_PATH = os.path.join(BASE_DIR, '.env')
@@ -121,6 +171,100 @@ app.config['CELERY_BROKER_URL'] = 'redis://localhost:6379/0'
 app.config['CELERY_RESULT_BACKEND'] = 'redis://localhost:6379/0'
 celery = Celery(app.name, broker=app.config['CELERY_BROKER_URL'])
 celery.conf.update(app.config)
+# Progress events of running tasks, streamed to clients by /stream_task
+events = TaskEvents(app.config['CELERY_RESULT_BACKEND'])
+# Task owners and DPIA leases, so an interrupted DPIA can be told apart from a running one
+task_registry = redis.Redis.from_url(app.config['CELERY_RESULT_BACKEND'])
+# Heartbeats of the DPIA leases held by tasks of this worker process, by task id
+dpia_leases = {}
+# Request threads of this server process that may be held by event streams
+stream_slots = threading.BoundedSemaphore(MAX_STREAMS)
+
+
+def dpia_running(dpia_id):
+    # A DPIA is being generated while its lease is alive, the task state is not used as a task lost with its
+    # worker stays PENDING or PROGRESS forever, while its lease expires DPIA_LEASE_TTL seconds later
+    return task_registry.exists(f"dpia_lease:{dpia_id}") > 0
+
+def acquire_dpia_lease(dpia_id, task_id):
+    # Take the lease of the DPIA unless another run holds it, and renew it from a heartbeat thread until
+    # release_dpia_lease, start_task takes it first so a queued run also counts as running
+    key = f"dpia_lease:{dpia_id}"
+    holder = task_registry.get(key)
+    if holder is not None and holder.decode() != task_id:
+        return False
+    task_registry.set(key, task_id, ex=DPIA_LEASE_TTL)
+    stop = threading.Event()
+
+    def heartbeat():
+        while not stop.wait(DPIA_LEASE_TTL / 3):
+            task_registry.set(key, task_id, ex=DPIA_LEASE_TTL)
+
+    threading.Thread(target=heartbeat, daemon=True).start()
+    dpia_leases[task_id] = (key, stop)
+    return True
+
+def release_dpia_lease(task_id):
+    # Stop the heartbeat and free the DPIA, unless a newer run took the lease over in the meantime
+    key, stop = dpia_leases.pop(task_id, (None, None))
+    if key is None:
+        return
+    stop.set()
+    if task_registry.get(key) == task_id.encode():
+        task_registry.delete(key)
+
+def dpia_template_path(user_id, dpia):
+    # The template a DPIA was started with is kept next to its PDF, so a resumed run writes the same sections
+    return os.path.join(BASE_DIR, 'dpias', str(user_id), str(dpia.projectID), f"{dpia.title}.json")
+
+
+def task_progress(task, info):
+    # Store the progress as the Celery state of the task and push it to stream readers
+    task.update_state(state='PROGRESS', meta=info)
+    events.publish(task.request.id, "progress", info)
+
+
+@celery.task
+def cleanup_paths(paths):
+    # Remove the files and directories moved to the trash by delete requests, off the request path
+    remove_paths(paths)
+
+
+@worker_ready.connect
+def sweep_trash(**kwargs):
+    # Queue the removal of anything left in the trash by cleanup jobs lost to a restart
+    trash_dir = os.path.join(BASE_DIR, "trash")
+    leftovers = [os.path.join(trash_dir, name) for name in os.listdir(trash_dir)] if os.path.isdir(trash_dir) else []
+    if leftovers: # every worker start would otherwise queue a job with nothing to remove
+        cleanup_paths.delay(leftovers)
+
+
+@task_failure.connect
+def publish_failure(task_id=None, exception=None, **kwargs):
+    # End the event stream of a failed task at once, rather than when the reader next polls its state
+    events.publish(task_id, "error", {"status": str(exception)})
+
+
+@task_revoked.connect
+def publish_revoked(request=None, **kwargs):
+    events.publish(request.id, "error", {"status": "task cancelled"})
+    events.finish(request.id)
+
+
+@task_postrun.connect
+def publish_finished(task_id=None, **kwargs):
+    # Sent once the result is stored, wakes the /get_task_result requests long-polling the task
+    release_dpia_lease(task_id)
+    events.finish(task_id)
+
+
+@worker_process_init.connect
+def warm_knowledge_base(**kwargs):
+    # Load (and if data.txt changed, re-index) the knowledge base before the first chat message arrives
+    try:
+        knowledge_base.load()
+    except Exception as e:
+        print(f"Knowledge base not warmed: {e}")
 
 
 @app.route('/register', methods=['POST'])
@@ -184,22 +328,24 @@ def refresh_page():
     user = User.query.filter_by(email=email).first()
 
     inspector = celery.control.inspect()
-    # Get all active tasks
+    # Get all active tasks, cleanup jobs are left to run so nothing moved to the trash is left behind
     active_tasks = inspector.active()
     if active_tasks:
         for worker, tasks in active_tasks.items():
             for task in tasks:
-                celery.control.revoke(task['id'], terminate=True)
+                if task['name'] != cleanup_paths.name:
+                    celery.control.revoke(task['id'], terminate=True)
 
     # Get all reserved tasks (waiting to be executed)
     reserved_tasks = inspector.reserved()
     if reserved_tasks:
         for worker, tasks in reserved_tasks.items():
             for task in tasks:
-                celery.control.revoke(task['id'], terminate=True)
+                if task['name'] != cleanup_paths.name:
+                    celery.control.revoke(task['id'], terminate=True)
 
-    vectorstore = Chroma(collection_name=f"summary_{user.userID}", embedding_function=embeddings, persist_directory=BASE_DIR + "/vectorDB/")
-    clear_chat_embed(vectorstore, user.userID, BASE_DIR)
+    vectorstore = vectorstores.get(user.userID)
+    cleanup_paths.delay(clear_chat_embed(vectorstore, user.userID, BASE_DIR, answer_cache))
 
     return "Refresh operations success", 200
 
@@ -215,35 +361,55 @@ def start_task():
     if task_name == 'get_msg':
         task = get_msg.apply_async(args=[data])
     if task_name == 'generate_dpia':
-        # Path to the text file
-        file_path = os.path.join(BASE_DIR, 'template', str(get_jwt_identity()), 'select.txt')
+        # Start a DPIA created by /init_dpia, or resume one whose last run was interrupted,
+        # sections saved by earlier runs are reused by the task
+        dpia = DPIA.query.get(data.get('dpiaID'))
+        project = Project.query.get(dpia.projectID) if dpia else None
+        if project is None or str(project.userID) != user_id:
+            return jsonify({'error': 'DPIA not found'}), 404
+        if dpia.status != 'working':
+            return jsonify({'error': 'DPIA already completed'}), 400
+        if dpia_running(dpia.dpiaID):
+            return jsonify({'error': 'DPIA is already being generated'}), 409
+
+        template_path = dpia_template_path(user_id, dpia)
+        if not os.path.exists(template_path):
+            check_path(os.path.dirname(template_path))
+            shutil.copy(os.path.join(BASE_DIR, 'template', user_id, 'select.txt'), template_path)
         # Read the file content
-        with open(file_path, 'r') as file:
+        with open(template_path, 'r') as file:
             template = json.load(file)
 
-        data['template'] = template
+        dpia_files = [File.query.get(dpia_file.fileID) for dpia_file in DPIA_File.query.filter_by(dpiaID=dpia.dpiaID)]
+        data.update(projectID=dpia.projectID, title=dpia.title, fileName=[file.fileName for file in dpia_files if file], template=template)
         task = generate_dpia.apply_async(args=[data])
+        # Hold the lease while the task is queued, the worker renews it once the task runs
+        task_registry.set(f"dpia_lease:{dpia.dpiaID}", task.id, ex=DPIA_LEASE_TTL)
     if task_name == 'extract_template':
         task = extract_template.apply_async(args=[data])
 
-    return jsonify({'task_id': task.id}), 202
+    # Only the user who started the task may read its events
+    task_registry.set(f"task_owner:{task.id}", user_id, ex=events.ttl)
+    # EventSource cannot send the JWT as a header, the stream is opened with a short-lived token of this task
+    # only, so no access token ends up in query strings and server logs
+    stream_token = secrets.token_urlsafe(32)
+    task_registry.set(f"stream_token:{stream_token}", task.id, ex=STREAM_TOKEN_TTL)
+    return jsonify({'task_id': task.id, 'stream_token': stream_token}), 202
 
 
 @app.route('/get_task_result', methods=['GET'])
 @jwt_required()
 def get_task_result():
     task_id = request.args.get('taskID')
-    task_name = request.args.get('taskName')
-
-    if task_name == 'get_msg':
-        task = get_msg.AsyncResult(task_id)
-    if task_name == 'generate_dpia':
-        task = generate_dpia.AsyncResult(task_id)
-    if task_name == 'extract_template':
-        task = extract_template.AsyncResult(task_id)
-   # Poll for task status until it's no longer 'PENDING'
-    while task.status == 'PENDING':
-        time.sleep(1)  # Wait for 1 second before checking again
+    task = AsyncResult(task_id, app=celery)
+    # Returns immediately, or long-polls for up to `wait` seconds, the worker publishes when the task finishes
+    # and each waiting request listens on its own Redis connection, so no request thread sleeps through a whole DPIA job
+    try:
+        wait = min(float(request.args.get('wait', 0)), 30)
+    except ValueError:
+        return jsonify({'error': 'wait must be a number of seconds'}), 400
+    if wait > 0:
+        events.wait(task_id, task.ready, wait)
 
     # Return the task status and result
     if task.status == 'SUCCESS':
@@ -251,19 +417,45 @@ def get_task_result():
             'state': task.state,
             'result': task.result
         }
-    if task.status == 'REVOKED':
+    elif task.status == 'REVOKED':
         response = {
             'state': task.state,
             'status': 'task cancelled'
         }
-
-    if task.status == 'FAILURE':
+    elif task.status == 'FAILURE':
         response = {
             'state': task.state,
             'status': str(task.info),  # Exception info if task failed
         }
+    else:
+        response = {
+            'state': task.state,
+            'progress': task.info if task.status == 'PROGRESS' else None,
+        }
     return jsonify(response), 200
 
+@app.route('/stream_task', methods=['GET'])
+def stream_task():
+    # Server-sent events of a task: ingestion progress, completed DPIA sections, chat answer tokens and the final result
+    # Authorised by the stream token start_task returned with the task, it opens one stream of that task only
+    # Each open stream holds a request thread of the threaded server until its task finishes, so at most
+    # MAX_STREAMS are open at once, further readers get 429 and rely on long-polling /get_task_result
+    task_id = request.args.get('taskID')
+    token_key = f"stream_token:{request.args.get('token', '')}"
+    pipe = task_registry.pipeline()
+    pipe.get(token_key)
+    pipe.delete(token_key)
+    granted, _ = pipe.execute()
+    if granted is None or granted.decode() != task_id:
+        return jsonify({'error': 'Task not found'}), 404
+    if not stream_slots.acquire(blocking=False):
+        return jsonify({'error': 'Too many open streams'}), 429
+    task = AsyncResult(task_id, app=celery)
+    response = Response(events.stream(task_id, task.ready), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(stream_slots.release)
+    return response
+
 @app.route('/cancel_task', methods=['POST'])
 @jwt_required()
 def cancel_task():
@@ -279,6 +471,8 @@ def get_msg(self, data):
     with app.app_context():
 
         model = ChatOllama(model="gemma2", temperature=0.0, num_ctx=8000)
+        # The final formatting pass streams its tokens to /stream_task readers
+        stream_model = ChatOllama(model="gemma2", temperature=0.0, num_ctx=8000, callbacks=[TokenStream(events, self.request.id)])
         parition_model = ChatOllama(model="phi3:3.8b-mini-128k-instruct-q8_0", temperature=0.0, num_ctx=8000)
         user_id = data.get('user_id', '')
         sequential_response = ''
@@ -286,6 +480,8 @@ def get_msg(self, data):
         msg = data.get('message', '') # Get the user message
         filename = data.get('fileName', '') # Get the filename
         pdfMode = data.get('pdfMode', '') # Get the pdfMode
+        synthesis = data.get('synthesis', SYNTHESIS_MODE) # Get the synthesis mode
+        retrieval = data.get('retrieval', RETRIEVAL_MODE) # Get the retrieval mode
         filenames = [filename] # Get the filenames
 
         IMG_DIR_C = os.path.join(BASE_DIR, "figures", data.get('user_id', ''), "chat")
@@ -295,11 +491,24 @@ def get_msg(self, data):
         for directory in [IMG_DIR_C, IMG_DIR_CD]:
             check_path(directory)
 
+        # Reuse the answer of a similar question already asked about the same document
+        document_path = os.path.join(UP_DIR_C, filename) if pdfMode else os.path.join(BASE_DIR, "chatData", "data.txt")
+        answer_scope = AnswerCache.scope(user_id, file_digest(document_path), model.model, synthesis, retrieval) if os.path.isfile(document_path) else None
+        query_vector = embeddings.embed_query(msg)
+        if answer_scope is not None:
+            cached = answer_cache.get(answer_scope, query_vector)
+            if cached is not None:
+                answer, similarity = cached
+                print(f"Answer cache hit, similarity {similarity:.3f}")
+                events.publish(self.request.id, "progress", {"stage": "cached", "similarity": round(similarity, 3)})
+                events.publish(self.request.id, "done", answer)
+                return answer
+
         format_chat = Agent(
             role="Chat Assistant",
             goal="Formatting the information provided by the user into a light-hearted response.",
             backstory="Expert in analyzing and proofreading user responses.",
-            llm=model,
+            llm=stream_model,
             allow_delegation=False,
         )
 
@@ -327,27 +536,24 @@ def get_msg(self, data):
                 verbose=False
             )
             # Process the document
-            retriever = partition_process(UP_DIR_C, user_id, '0', filenames, IMG_DIR_C, IMG_DIR_CD, parition_model, embeddings, filter, id_key, file_name, embed_type, usage, "chat")
-            context = retriever.invoke(msg)
+            retriever = partition_process(UP_DIR_C, user_id, '0', filenames, IMG_DIR_C, IMG_DIR_CD, parition_model, embeddings, filter, id_key, file_name, embed_type, usage, "chat",
+                                          workers=PARTITION_WORKERS, progress=lambda info: task_progress(self, info), cache=ingest_cache, page_window=PAGE_WINDOW,
+                                          summary_cache=summary_cache, vectorstores=vectorstores)
+            events.publish(self.request.id, "progress", {"stage": "retrieving"})
+            context = retrieve(retriever, VectorStorePool.collection_name(user_id), msg, retrieval, RETRIEVAL_CANDIDATES)
             page_content = [doc.page_content for doc in context]
             rerank_content = rerank_response(msg, page_content)
-            # Split the content into chunks, multi-chain
-            split_content = split_text_into_chunks(''.join(rerank_content))
-            for content in enumerate(split_content):      
-                pdf_answer = Task(
-                    description= (f"""Based on the provided document inforamtion: {sequential_response}\n {content}\n
-                                Please provide a friendly professional response to the user query: {msg}"""),
-                    expected_output=(f"""Return a concise and accurate response."""),
-                    agent=pdf_msg
-                )
-                crew = Crew(
-                    agents=[pdf_msg],
-                    tasks=[pdf_answer],
-                    processes=Process.sequential
-                )
-                sequential_response = crew.kickoff().raw
+            describe = lambda previous, content: (f"""Based on the provided document inforamtion: {previous}\n {content}\n
+                                Please provide a friendly professional response to the user query: {msg}""")
+            # Pack the passages into as few windows as fit the context of the model, multi-chain
+            counter = token_counter(model.model)
+            split_content, calls_saved = pack_context(rerank_content, counter, prompt_tokens(counter, describe, pdf_msg))
+            print(f"Context packed into {len(split_content)} windows, {calls_saved} LLM calls saved")
+            events.publish(self.request.id, "progress", {"stage": "answering", "windows": len(split_content), "calls_saved": calls_saved})
+            sequential_response = synthesise_response(synthesis, split_content, describe, f"""Return a concise and accurate response.""",
+                                                      msg, pdf_msg, SYNTHESIS_WORKERS)
             
-            crew = expanded_response(pdf_answer, rerank_content, msg, pdf_msg, format_chat)
+            crew = expanded_response(sequential_response, rerank_content, msg, pdf_msg, format_chat)
             msg_response = crew.kickoff()
         else:
             default_msg = Agent(
@@ -359,41 +565,38 @@ def get_msg(self, data):
                 verbose=False
             )
             
-            context = create_chatData(BASE_DIR, embeddings, msg) # create knowledge base
+            events.publish(self.request.id, "progress", {"stage": "retrieving"})
+            context = retrieve(knowledge_base.load(), knowledge_base.collection, msg, retrieval, RETRIEVAL_CANDIDATES) # query the built-in knowledge base
             page_content = [doc.page_content for doc in context]
             rerank_content = rerank_response(msg, page_content)
-            # Split the content into chunks, multi-chain
-            split_content = split_text_into_chunks(''.join(rerank_content))
-            for content in enumerate(split_content): 
-                msg_answer = Task(
-                    description= (f"""Based on the provided inforamtion: {sequential_response}\n {content}\n
-                                Please provide a friendly professional response to the user query: {msg}"""),
-                    expected_output=(f"""Return a concise and accurate response."""),
-                    agent=default_msg,
-                )
-
-                crew = Crew(
-                    agents=[default_msg],
-                    tasks=[msg_answer],
-                    processes=Process.sequential
-                )
-                sequential_response = crew.kickoff().raw
-
-            crew = expanded_response(msg_answer, rerank_content, msg, default_msg, format_chat)
+            describe = lambda previous, content: (f"""Based on the provided inforamtion: {previous}\n {content}\n
+                                Please provide a friendly professional response to the user query: {msg}""")
+            # Pack the passages into as few windows as fit the context of the model, multi-chain
+            counter = token_counter(model.model)
+            split_content, calls_saved = pack_context(rerank_content, counter, prompt_tokens(counter, describe, default_msg))
+            print(f"Context packed into {len(split_content)} windows, {calls_saved} LLM calls saved")
+            events.publish(self.request.id, "progress", {"stage": "answering", "windows": len(split_content), "calls_saved": calls_saved})
+            sequential_response = synthesise_response(synthesis, split_content, describe, f"""Return a concise and accurate response.""",
+                                                      msg, default_msg, SYNTHESIS_WORKERS)
+
+            crew = expanded_response(sequential_response, rerank_content, msg, default_msg, format_chat)
             msg_response = crew.kickoff()
         
         for i in range(10):
             if self.request.called_directly:  # Check if the task is being revoked
                 break
             time.sleep(1)  # Simulate a long process
+        if answer_scope is not None:
+            answer_cache.put(user_id, answer_scope, msg, query_vector, msg_response.raw)
+        events.publish(self.request.id, "done", msg_response.raw)
         return msg_response.raw
             
 
 @app.route('/clear_chat', methods=['GET'])
 @jwt_required()
 def clear_chat():
-    vectorstore = Chroma(collection_name=f"summary_{get_jwt_identity()}", embedding_function=embeddings, persist_directory=BASE_DIR + "/vectorDB/")
-    clear_chat_embed(vectorstore, get_jwt_identity(), BASE_DIR)
+    vectorstore = vectorstores.get(get_jwt_identity())
+    cleanup_paths.delay(clear_chat_embed(vectorstore, get_jwt_identity(), BASE_DIR, answer_cache))
     
     return jsonify({"message": 'Chat cleared'})
 
@@ -497,7 +700,8 @@ def get_documents():
 @jwt_required()
 def delete_document():
     file_ids = request.get_json()
-    vectorstore = Chroma(collection_name=f"summary_{get_jwt_identity()}", embedding_function=embeddings, persist_directory=BASE_DIR + "/vectorDB/")
+    vectorstore = vectorstores.get(get_jwt_identity())
+    moved = [] # paths removed by the background cleanup
 
     for file_id in file_ids:
         document = File.query.get(file_id)
@@ -507,29 +711,23 @@ def delete_document():
             data_path = os.path.join(BASE_DIR, 'vectorDB', 'parentData', str(get_jwt_identity()), str(document.projectID), document.fileName)
             DIR_P = os.path.join(BASE_DIR, "vectorDB", "parentData", str(get_jwt_identity()), str(document.projectID), document.fileName + ".pdf")
 
-            existing_documents = vectorstore.get(where={
+            delete_embeddings(vectorstore, VectorStorePool.collection_name(get_jwt_identity()), {
                 "$and": [
                     {"file_name": document.fileName + ".pdf"},
                     {"usage": f"project_{document.projectID}"}
                 ]
-                })['ids']
-            
-            for ids in existing_documents:
-                vectorstore.delete(ids)
-
-            # Remove the file from the directory
-            if os.path.exists(file_path):
-                os.remove(file_path)
+                })
 
-            for path in [data_path, DIR_P]:
-                if os.path.exists(path) and os.path.isdir(path):
-                    shutil.rmtree(path)
+            # Remove the file and its parent documents from the directory in the background
+            moved.extend(move_to_trash(BASE_DIR, [file_path, data_path, DIR_P]))
 
             db.session.delete(document)
             db.session.commit()
         else:
+            cleanup_paths.delay(moved)
             return jsonify({'error': 'File not found'}), 404
     
+    cleanup_paths.delay(moved)
     return jsonify({'success': True}), 200
     
 
@@ -768,7 +966,8 @@ def get_projects():
 @jwt_required()
 def delete_project():
     project_ids = request.get_json()
-    vectorstore = Chroma(collection_name=f"summary_{get_jwt_identity()}", embedding_function=embeddings, persist_directory=BASE_DIR + "/vectorDB/")
+    vectorstore = vectorstores.get(get_jwt_identity())
+    moved = [] # paths removed by the background cleanup
 
     for project_id in project_ids:
         project = Project.query.get(project_id)
@@ -782,69 +981,34 @@ def delete_project():
             folder_path_file = os.path.join(BASE_DIR, 'uploads', str(get_jwt_identity()), str(project_id))
             folder_path_dpia = os.path.join(BASE_DIR, 'dpias', str(get_jwt_identity()), str(project_id))
 
-            # Delete the files
-            for file in files:
-                # Construct the file path
-                file_path = os.path.join(BASE_DIR, 'uploads', str(get_jwt_identity()), str(project_id), file.fileName)
-                DIR_P = os.path.join(BASE_DIR, "vectorDB", "parentData", str(get_jwt_identity()), str(project_id), file.fileName)
+            # Delete the embeddings of all files of the project in one operation
+            delete_embeddings(vectorstore, VectorStorePool.collection_name(get_jwt_identity()), {"usage": f"project_{project_id}"})
 
-                existing_documents = vectorstore.get(where={
-                "$and": [
-                    {"file_name": file.fileName + ".pdf"},
-                    {"usage": f"project_{project_id}"}
-                ]
-                })['ids']
-            
-                for ids in existing_documents:
-                    vectorstore.delete(ids)
-
-                if os.path.exists(DIR_P) and os.path.isdir(DIR_P):
-                    shutil.rmtree(DIR_P)
-
-                try:
-                    # Remove the folder from the directory
-                    if os.path.exists(file_path):
-                        os.remove(file_path)
-                except Exception as e:
-                    return jsonify({'error': str(e)}), 500
-                
-                # Delete the file record from the database
+            # Delete the file records from the database
+            for file in files:
                 db.session.delete(file)
             
-            # Delete parentData
-            data_path = os.path.join(BASE_DIR, 'vectorDB', 'parentData', str(get_jwt_identity()), str(project_id))
-            if os.path.exists(data_path) and os.path.isdir(data_path):
-                shutil.rmtree(data_path)
-            
-            # Delete the DPIAs
+            # Delete the DPIA records from the database
             for dpia in dpias:
-                # Construct the dpia path
-                dpia_path = os.path.join(BASE_DIR, 'dpias', str(get_jwt_identity()), str(project_id), dpia.title + ".pdf")
-
-                try:
-                    # Remove the dpia from the directory
-                    if os.path.exists(dpia_path):
-                        os.remove(dpia_path)
-                except Exception as e:
-                    return jsonify({'error': str(e)}), 500
-                
-                # Delete the dpia record from the database
                 db.session.delete(dpia)
             
             # Delete the DPIA files
             for dpia_file in dpia_files:
                 db.session.delete(dpia_file)
+            # Delete the saved sections
+            DPIA_Section.query.filter(DPIA_Section.dpiaID.in_([dpia.dpiaID for dpia in dpias])).delete(synchronize_session=False)
             
+            # Remove the uploads, DPIAs and parentData of the project in the background
+            data_path = os.path.join(BASE_DIR, 'vectorDB', 'parentData', str(get_jwt_identity()), str(project_id))
+            moved.extend(move_to_trash(BASE_DIR, [folder_path_file, folder_path_dpia, data_path]))
             # Delete the project record from the database
-            if os.path.exists(folder_path_file) and os.path.isdir(folder_path_file):
-                shutil.rmtree(folder_path_file)
-            if os.path.exists(folder_path_dpia) and os.path.isdir(folder_path_dpia):
-                shutil.rmtree(folder_path_dpia)
             db.session.delete(project)
             db.session.commit()
         else:
+            cleanup_paths.delay(moved)
             return jsonify({'error': 'Project not found'}), 404
     
+    cleanup_paths.delay(moved)
     return jsonify({'success': True}), 200
 
 
@@ -869,6 +1033,7 @@ def get_dpias():
             'dpiaID': dpia.dpiaID,
             'title': dpia.title,
             'status': dpia.status,
+            'running': dpia.status == 'working' and dpia_running(dpia.dpiaID), # working but not running means interrupted
             'tempName': temp_name
         })
 
@@ -886,14 +1051,18 @@ def delete_dpia():
 
         for dpia_file in dpia_files:
             db.session.delete(dpia_file)
+        # Delete the saved sections
+        DPIA_Section.query.filter_by(dpiaID=dpia_id).delete()
 
         if dpia:
             # Construct the dpia path
             dpia_path = os.path.join(BASE_DIR, 'dpias', str(get_jwt_identity()), str(dpia.projectID), dpia.title + ".pdf")
 
-            # Remove the dpia from the directory
-            if os.path.exists(dpia_path):
-                os.remove(dpia_path)
+            # Remove the dpia and the template it was written with from the directory
+            for path in [dpia_path, dpia_template_path(get_jwt_identity(), dpia)]:
+                if os.path.exists(path):
+                    os.remove(path)
+            task_registry.delete(f"dpia_lease:{dpia_id}")
 
             db.session.delete(dpia)
             db.session.commit()
@@ -984,6 +1153,13 @@ def generate_dpia(self, data):
         file_names = sorted(data.get('fileName')) # Get the file names
         dpia_id = data.get('dpiaID') # Get the DPIA ID
         template = data.get('template') # Get the template
+        synthesis = data.get('synthesis', SYNTHESIS_MODE) # Get the synthesis mode
+        retrieval = data.get('retrieval', RETRIEVAL_MODE) # Get the retrieval mode
+
+        # A run queued so long that its lease expired and the DPIA was started again gives way to the newer run
+        if not acquire_dpia_lease(dpia_id, self.request.id):
+            events.publish(self.request.id, "error", {"status": "superseded by a newer run of the DPIA"})
+            return
 
         # Create a DPIA report
         assign_model = ChatOllama(model="qwen2:7b-instruct-q8_0", temperature=0.0, num_ctx=8000)
@@ -1003,20 +1179,31 @@ def generate_dpia(self, data):
         usage = "usage"
 
         retriever = partition_process(UP_DIR_R, data.get('user_id', ''), str(project_id), file_names, IMG_DIR_R, IMG_DIR_RD, partition_model, embeddings, 
-                                      'n/a', id_key, file_name, embed_type, usage, f"project_{project_id}")
+                                      'n/a', id_key, file_name, embed_type, usage, f"project_{project_id}",
+                                      workers=PARTITION_WORKERS, progress=lambda info: task_progress(self, info), cache=ingest_cache, page_window=PAGE_WINDOW,
+                                      summary_cache=summary_cache, vectorstores=vectorstores, file_quota=FILE_QUOTA)
         # Assign role and backstory to the agent
         assign_query = """Based on the provided context: {context}. Provide a 'Role', and a 'Backstory' with one sentence. Your response must be in key-value JSON format."""
         assign_prompt = ChatPromptTemplate.from_template(assign_query)
         parser = StrOutputParser()
         assign_chain = assign_prompt | assign_model | parser
 
-        dpia_text = {} # Store the DPIA text
-        visited_keys = [] # Store the visited keys
-        visited_sections = [] # Store the visited sections
+        # Retrieve the context of every section up front and rerank all of them in one batched pass
+        # Sections completed by an earlier run of this DPIA are reused as long as their prompt is unchanged
+        saved = {(row.step, row.section): row.content for row in session.query(DPIA_Section).filter_by(dpiaID=dpia_id)
+                 if template.get(row.step, {}).get(row.section, {}).get('content') == row.prompt}
+        missing = {step_key: [part_key for part_key in step_value if (step_key, part_key) not in saved] for step_key, step_value in template.items()}
+        missing = {step_key: part_keys for step_key, part_keys in missing.items() if part_keys}
+        print(f"Resuming DPIA {dpia_id}: {len(saved)} sections already written")
 
-        # Loop through each key-value pair in the data and store them in the dictionary
-        for step_key, step_value in template.items():
-            visited_keys.append(step_key)
+        prompts = {template[step_key][part_key]['content'] for step_key, part_keys in missing.items() for part_key in part_keys}
+        contexts = {prompt: [f"{doc.page_content}" for doc in retrieve(retriever, VectorStorePool.collection_name(data.get('user_id', '')), prompt, retrieval, RETRIEVAL_CANDIDATES)] for prompt in prompts}
+        try:
+            reranked = dict(zip(contexts.keys(), rerank_responses(list(contexts.items()))))
+        except:
+            reranked = contexts
+
+        def assign_role(step_key, step_value):
             # read the content of the step, and assign the role and backstory based on the content
             overview = f"{step_key}: {step_value}\n" 
             assign_prompt.format(context=overview)
@@ -1024,9 +1211,16 @@ def generate_dpia(self, data):
             print('DEBUG: ', assign_answer )
             assign_answer = json.loads(assign_answer)
             # Get the role and backstory
-            role = assign_answer.get("Role")
-            backstory = assign_answer.get("Backstory")
-            # Create a writing agent
+            return assign_answer.get("Role"), assign_answer.get("Backstory")
+
+        # Assign the roles of all steps with sections left to write concurrently
+        with ThreadPoolExecutor(max_workers=SECTION_CONCURRENCY) as pool:
+            roles = dict(zip(missing.keys(), pool.map(assign_role, missing.keys(), [template[step_key] for step_key in missing])))
+
+        def write_section(step_key, part_key, prev_response):
+            # Write one section, prev_response is the answer of the section referenced in 'from', if any
+            role, backstory = roles[step_key]
+            # Create a writing agent, agents are per section so concurrent sections never share one
             writing_agent = Agent(
                 role=role,
                 goal=default_prompt,
@@ -1044,73 +1238,64 @@ def generate_dpia(self, data):
                 allow_delegation=False,
                 verbose=True
             )
-            # loop through each part of the step
-            part_text = {}
-            for part_key, part_value in step_value.items():
-                visited_sections.append(part_key)
-                prompt = part_value['content']
-                from_step = part_value['from']['Step']
-                from_section = part_value['from']['Section']
-
-                context = retriever.invoke(prompt)
-                sequential_answer = ''
-
-                page_content = [f"{doc.page_content}" for doc in context]
+            prompt = template[step_key][part_key]['content']
+            sequential_answer = ''
+
+            page_content = contexts[prompt]
+            rerank_content = reranked[prompt]
+
+            if not prompt.strip():
+                return ""
+            if prev_response is not None:
+                # use answer from previous part to be the input for the current part
+                passages = rerank_content
+                describe = lambda previous, content: (f"""Background information: {prev_response}\n 
+                                        Based on the background information and the provided context: {previous}, {content}\n 
+                                        Provide a detailed answer to the prompt: {prompt}.
+                                        References and citations are not relevant.""")
+            else:
+                passages = page_content
+                describe = lambda previous, content: (f"""Based on the provided context: {previous}\n {content}\n 
+                                        Provide a detailed answer to the prompt: {prompt}.
+                                        References and citations are not relevant.""")
+            # Pack the passages into as few windows as fit the context of the model, multi-chain
+            counter = token_counter(general_model.model)
+            split_content, calls_saved = pack_context(passages, counter, prompt_tokens(counter, describe, writing_agent))
+            print(f"{step_key} {part_key}: context packed into {len(split_content)} windows, {calls_saved} LLM calls saved")
+            sequential_answer = synthesise_response(synthesis, split_content, describe,
+                                                    f"""Return an accurate and coherent response in a professional tone.""",
+                                                    prompt, writing_agent, SYNTHESIS_WORKERS)
+            # post process the response
+            crew = expanded_response(sequential_answer, rerank_content, prompt, writing_agent, Format_agent)
+            # final response
+            response = crew.kickoff().raw
+            return f"""{response}"""
+
+        total_sections = sum(len(step_value) for step_value in template.values())
+        completed_sections = []
+
+        def resume_section(step_key, part_key, prev_response):
+            # Write the section unless an earlier run already did, and persist it as soon as it is complete
+            if (step_key, part_key) in saved:
+                content = saved[(step_key, part_key)]
+            else:
+                content = write_section(step_key, part_key, prev_response)
+                checkpoint = Session() # sections complete on worker threads, each one uses its own session
                 try:
-                    rerank_content = rerank_response(prompt, page_content)
-                except:
-                    rerank_content = page_content
-                
-                if not prompt.strip():
-                    part_text[f"""{part_key}"""] = ""
-                else:
-                    if from_step in visited_keys and from_section in visited_sections: # Check if the from_step and from_section are in the visited keys and sections
-                        try:
-                            prev_response = dpia_text[from_step][from_section]
-                        except:
-                            prev_response = part_text[from_section]
-                        # use answer from previous part to be the input for the current part
-                        split_content = split_text_into_chunks(''.join(rerank_content)) # Split the content into chunks, multi-chain
-                        for content in enumerate(split_content):        
-                            initial_answer = Task(
-                                description= (f"""Background information: {prev_response}\n 
-                                                Based on the background information and the provided context: {sequential_answer}, {content}\n 
-                                                Provide a detailed answer to the prompt: {prompt}.
-                                                References and citations are not relevant."""),
-                                expected_output=(f"""Return an accurate and coherent response in a professional tone."""),
-                                agent=writing_agent,
-                            )
-
-                            crew = Crew(
-                                agents=[writing_agent],
-                                tasks=[initial_answer],
-                                processes=Process.sequential,
-                            )
-                            sequential_answer = crew.kickoff().raw
-                    else:
-                        split_content = split_text_into_chunks(''.join(page_content)) # Split the content into chunks, multi-chain
-                        for content in enumerate(split_content):
-                            initial_answer = Task(
-                                description= (f"""Based on the provided context: {sequential_answer}\n {content}\n 
-                                                Provide a detailed answer to the prompt: {prompt}.
-                                                References and citations are not relevant."""),
-                                expected_output=(f"""Return an accurate and coherent response in a professional tone."""),
-                                agent=writing_agent,
-                            )
-
-                            crew = Crew(
-                                agents=[writing_agent],
-                                tasks=[initial_answer],
-                                processes=Process.sequential,
-                            )
-                            sequential_answer = crew.kickoff().raw
-                    # post process the response
-                    crew = expanded_response(sequential_answer, rerank_content, prompt, writing_agent, Format_agent)
-                    # final response
-                    response = crew.kickoff().raw
-                    part_text[f"""{part_key}"""] = f"""{response}""" # append the response to the part
-            dpia_text[f"""{step_key}"""] = part_text # append the part to the step
-            
+                    checkpoint.query(DPIA_Section).filter_by(dpiaID=dpia_id, step=step_key, section=part_key).delete()
+                    checkpoint.add(DPIA_Section(dpiaID=dpia_id, step=step_key, section=part_key,
+                                                prompt=template[step_key][part_key]['content'], content=content))
+                    checkpoint.commit()
+                finally:
+                    checkpoint.close()
+            completed_sections.append((step_key, part_key))
+            events.publish(self.request.id, "section", {"step": step_key, "section": part_key, "text": content,
+                                                        "completed": len(completed_sections), "total": total_sections})
+            return content
+
+        # Sections run concurrently unless they take their input 'from' an earlier section
+        dpia_text = run_sections(template, resume_section, SECTION_CONCURRENCY)
+
         dpia_json_text = json.dumps(dpia_text, indent=4) # Format the JSON response
         dpia = json.loads(dpia_json_text)
 
@@ -1128,6 +1313,7 @@ def generate_dpia(self, data):
         filter(DPIA.dpiaID == dpia_id).\
         update({'status': 'completed'})
         session.commit() 
+        events.publish(self.request.id, "done", {"dpiaID": dpia_id, "title": title})
 
         for i in range(10):
             if self.request.called_directly:  # Check if the task is being revoked
@@ -1194,5 +1380,11 @@ def usage_metric():
     return jsonify(info), 200
 
 
+@app.route('/cache_metric', methods=['GET'])
+@jwt_required()
+def cache_metric():
+    return jsonify({'ingest': ingest_cache.stats(), 'summary': summary_cache.stats(), 'embedding': embeddings.cache.stats(), 'answer': answer_cache.stats()}), 200
+
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=8080, debug=True, threaded=True)
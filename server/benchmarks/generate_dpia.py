@@ -0,0 +1,219 @@
+"""End-to-end generate_dpia benchmark against a stand-in Ollama server.
+
+Runs the real generate_dpia task in-process (partition, summarise, caption,
+retrieve, rerank, Crew kickoffs, DPIAPDFGenerator) on sample PDFs and the
+bundled UK ICO (Default).txt template. All chat and embedding calls go to
+benchmarks/stub_ollama.py on the Ollama port, so stop Ollama first or pass
+--no-stub to measure the real models. Reports per-stage wall time, LLM calls
+and tokens sent per model, and peak memory of the process and its children.
+
+Without --pdf, --files sample PDFs of --pages pages are written from
+chatData/data.txt. Caches are fresh per run unless --warm is given, and the
+benchmark user's collection, files and saved sections are removed afterwards.
+
+    python benchmarks/generate_dpia.py --files 3 --pages 30 --latency-ms 200 --tokens-per-s 40
+"""
+import os, sys, json, time, shutil, argparse, tempfile, threading
+from collections import defaultdict
+import psutil
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.platypus import Paragraph, SimpleDocTemplate, PageBreak, Table
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from stub_ollama import serve
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+USER_ID = "benchmark"
+PROJECT_ID = "0"
+DPIA_ID = -1
+
+
+class Stages:
+    # Wall time and call count of the instrumented pipeline stages
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = defaultdict(float)
+        self.calls = defaultdict(int)
+
+    def wrap(self, name, func):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.seconds[name] += time.perf_counter() - start
+                    self.calls[name] += 1
+        return timed
+
+
+class Events:
+    # Records the events the task publishes instead of sending them to Redis
+    def __init__(self):
+        self.done = threading.Event()
+        self.sections = 0
+        self.finished = None
+
+    def publish(self, task_id, event, data):
+        if event == "section":
+            self.sections += 1
+        if event == "done":
+            self.finished = time.perf_counter()
+            self.done.set()
+
+
+class MemorySampler(threading.Thread):
+    # Peak resident memory of the process and its partition workers
+    def __init__(self, interval=0.2):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = 0
+        self.running = True
+
+    def run(self):
+        process = psutil.Process()
+        while self.running:
+            try:
+                rss = process.memory_info().rss + sum(child.memory_info().rss for child in process.children(recursive=True))
+            except psutil.Error:
+                continue
+            self.peak = max(self.peak, rss)
+            time.sleep(self.interval)
+
+
+def sample_pdfs(directory, files, pages):
+    # Text PDFs cut from the knowledge base, with a table on every tenth page
+    with open(os.path.join(BASE_DIR, "chatData", "data.txt"), "r") as file:
+        paragraphs = [p.strip() for p in file.read().split("\n") if p.strip()]
+    styles = getSampleStyleSheet()
+    names = []
+    for f in range(files):
+        name = f"sample_{f + 1}"
+        story = []
+        for page in range(pages):
+            for i in range(4):
+                text = paragraphs[(f * pages * 4 + page * 4 + i) % len(paragraphs)]
+                story.append(Paragraph(text.replace("&", "&amp;").replace("<", "&lt;"), styles["Normal"]))
+            if page % 10 == 9:
+                story.append(Table([["Data", "Purpose", "Retention"]] + [[f"field {r}", "service delivery", f"{r + 1} years"] for r in range(5)]))
+            story.append(PageBreak())
+        SimpleDocTemplate(os.path.join(directory, name + ".pdf"), pagesize=A4).build(story)
+        names.append(name)
+    return names
+
+def cleanup(app):
+    app.delete_embeddings(app.vectorstores.get(USER_ID), {"usage": f"project_{PROJECT_ID}"})
+    for path in [os.path.join(BASE_DIR, "uploads", USER_ID), os.path.join(BASE_DIR, "figures", USER_ID),
+                 os.path.join(BASE_DIR, "dpias", USER_ID), os.path.join(BASE_DIR, "vectorDB", "parentData", USER_ID)]:
+        shutil.rmtree(path, ignore_errors=True)
+    session = app.Session()
+    try:
+        session.query(app.DPIA_Section).filter_by(dpiaID=DPIA_ID).delete()
+        session.commit()
+    finally:
+        session.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pdf", nargs="*", default=[], help="PDFs to use instead of generated samples")
+    parser.add_argument("--files", type=int, default=2)
+    parser.add_argument("--pages", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=200, help="time to first token of a chat call")
+    parser.add_argument("--tokens-per-s", type=float, default=40)
+    parser.add_argument("--answer-tokens", type=int, default=150)
+    parser.add_argument("--embed-latency-ms", type=float, default=5)
+    parser.add_argument("--vision-latency-ms", type=float, default=500, help="per image, the vision model is stubbed too unless --no-stub")
+    parser.add_argument("--synthesis", choices=["refine", "map_reduce"])
+    parser.add_argument("--retrieval", choices=["vector", "hybrid"])
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--no-stub", action="store_true", help="use the running Ollama and vision model")
+    parser.add_argument("--warm", action="store_true", help="keep the ingestion, summary and embedding caches")
+    args = parser.parse_args()
+
+    stub = None
+    if not args.no_stub:
+        stub = serve(args.port, latency=args.latency_ms / 1000, tokens_per_s=args.tokens_per_s,
+                     answer_tokens=args.answer_tokens, embed_latency=args.embed_latency_ms / 1000)
+
+    import app, helper
+    from cache import IngestCache, SummaryCache, EmbeddingCache
+
+    scratch = tempfile.mkdtemp(prefix="generate_dpia_")
+    if not args.warm:
+        app.ingest_cache = IngestCache(os.path.join(scratch, "ingest.sqlite3"))
+        app.summary_cache = SummaryCache(os.path.join(scratch, "summary.sqlite3"))
+        app.embeddings.cache = EmbeddingCache(os.path.join(scratch, "embedding.sqlite3"))
+
+    stages = Stages()
+    events = Events()
+    app.events = events
+    app.task_progress = lambda task, info: None
+    app.partition_process = stages.wrap("ingest (total)", app.partition_process)
+    helper.summarise_chunks = stages.wrap("  summarise", helper.summarise_chunks)
+    helper.caption_images = stages.wrap("  caption", helper.caption_images)
+    app.retrieve = stages.wrap("retrieve", app.retrieve)
+    app.rerank_responses = stages.wrap("rerank", app.rerank_responses)
+    app.run_sections = stages.wrap("sections (total)", app.run_sections)
+    helper.answer_chunk = stages.wrap("  synthesis calls", helper.answer_chunk)
+    app.DPIAPDFGenerator.generate_pdf = stages.wrap("pdf", app.DPIAPDFGenerator.generate_pdf)
+    if not args.no_stub:
+        def captions(img_path, img_names):
+            time.sleep(args.vision_latency_ms / 1000 * len(img_names))
+            return [f"A figure from the document ({name})." for name in img_names]
+        helper.image_responses = captions
+
+    cleanup(app)
+    upload_dir = os.path.join(BASE_DIR, "uploads", USER_ID, PROJECT_ID)
+    os.makedirs(upload_dir, exist_ok=True)
+    if args.pdf:
+        file_names = []
+        for path in args.pdf:
+            shutil.copy(path, upload_dir)
+            file_names.append(os.path.splitext(os.path.basename(path))[0])
+    else:
+        file_names = sample_pdfs(upload_dir, args.files, args.pages)
+    with open(os.path.join(BASE_DIR, "template", "UK ICO (Default).txt"), "r") as file:
+        template = json.load(file)
+
+    data = {"user_id": USER_ID, "projectID": PROJECT_ID, "title": "Benchmark", "fileName": file_names,
+            "dpiaID": DPIA_ID, "template": template}
+    if args.synthesis:
+        data["synthesis"] = args.synthesis
+    if args.retrieval:
+        data["retrieval"] = args.retrieval
+
+    sampler = MemorySampler()
+    baseline = psutil.Process().memory_info().rss
+    sampler.start()
+    start = time.perf_counter()
+    result = {}
+    worker = threading.Thread(target=lambda: result.update(task=app.generate_dpia.apply(args=[data])), daemon=True)
+    worker.start()
+    while not events.done.wait(1) and worker.is_alive():
+        pass
+    sampler.running = False
+    worker.join() # the task idles for a few seconds after publishing "done"
+
+    try:
+        if not events.done.is_set():
+            print(f"generate_dpia failed:\n{result['task'].traceback}")
+            return
+        elapsed = events.finished - start
+        print(f"{len(file_names)} files, {events.sections} sections, {elapsed:.1f}s end to end")
+        for name, seconds in stages.seconds.items():
+            print(f"{name:<20} {seconds:8.1f}s  {stages.calls[name]} calls")
+        if stub is not None:
+            print(f"{'model':<36} {'calls':>6} {'prompt tokens':>14} {'completion':>11} {'seconds':>8}")
+            for model, stats in stub.stats.snapshot().items():
+                print(f"{model:<36} {stats['calls']:>6} {stats['prompt_tokens']:>14} {stats['completion_tokens']:>11} {stats['seconds']:>8.1f}")
+        print(f"memory: {baseline / 1024 ** 2:.0f} MB before the run, {sampler.peak / 1024 ** 2:.0f} MB peak including partition workers")
+    finally:
+        cleanup(app)
+        shutil.rmtree(scratch, ignore_errors=True)
+        if stub is not None:
+            stub.shutdown()
+
+
+if __name__ == "__main__":
+    main()
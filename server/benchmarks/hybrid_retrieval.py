@@ -0,0 +1,71 @@
+"""Compare vector-only and hybrid (vector + BM25) retrieval on the built-in knowledge base.
+
+Queries are the section prompts of the bundled UK ICO template. The relevant
+documents of a query are the top --relevant parents the CrossEncoder picks from
+a deep pool (vector and BM25 top 50 together), so recall@k measures how many of
+them each mode hands to the reranker. End-to-end latency is retrieval plus the
+rerank of the returned candidates, as in get_msg.
+
+    python benchmarks/hybrid_retrieval.py --queries 20 --candidates 8
+"""
+import os, sys, json, time, argparse, statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from langchain_community.embeddings import OllamaEmbeddings
+from helper import KnowledgeBase
+from hybrid import retrieve, hybrid_search
+from rerank import rerank_response
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_queries(limit):
+    with open(os.path.join(BASE_DIR, "template", "UK ICO (Default).txt"), "r") as file:
+        template = json.load(file)
+    prompts = [part["content"] for step in template.values() for part in step.values() if part["content"].strip()]
+    return prompts[:limit]
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[max(int(len(values) * q) - 1, 0)]
+
+def run(retriever, query, mode, candidates):
+    start = time.time()
+    docs = [doc.page_content for doc in retrieve(retriever, query, mode, candidates)]
+    retrieved = time.time() - start
+    rerank_response(query, docs)
+    return docs, retrieved, time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=20, help="number of template prompts")
+    parser.add_argument("--candidates", type=int, default=8, help="documents the hybrid mode hands to the reranker")
+    parser.add_argument("--relevant", type=int, default=5, help="reranker top documents counted as relevant")
+    args = parser.parse_args()
+
+    retriever = KnowledgeBase(BASE_DIR, OllamaEmbeddings(model="nomic-embed-text")).load()
+    queries = load_queries(args.queries)
+    rerank_response(queries[0], ["warm-up"]) # model loading is not part of the measurement
+
+    results = {"vector": {"recall": [], "retrieval": [], "total": [], "candidates": []},
+               "hybrid": {"recall": [], "retrieval": [], "total": [], "candidates": []}}
+    for query in queries:
+        pool = list(dict.fromkeys(doc.page_content for doc in hybrid_search(retriever, query, candidates=100, k=50)))
+        relevant = set(rerank_response(query, pool)[:args.relevant])
+        for mode, stats in results.items():
+            docs, retrieved, total = run(retriever, query, mode, args.candidates)
+            stats["recall"].append(len(relevant & set(docs)) / max(len(relevant), 1))
+            stats["retrieval"].append(retrieved)
+            stats["total"].append(total)
+            stats["candidates"].append(len(docs))
+
+    print(f"{len(queries)} queries, recall@k against the reranker's top {args.relevant} of a deep pool")
+    for mode, stats in results.items():
+        print(f"{mode:<7} candidates {statistics.mean(stats['candidates']):.1f}, "
+              f"recall {statistics.mean(stats['recall']):.3f}, "
+              f"retrieval p50 {statistics.median(stats['retrieval']) * 1000:.0f}ms, "
+              f"end-to-end p50 {statistics.median(stats['total']) * 1000:.0f}ms p95 {percentile(stats['total'], 0.95) * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
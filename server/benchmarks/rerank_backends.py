@@ -0,0 +1,74 @@
+"""Compare the PyTorch and int8 ONNX rerank backends on sample DPIA chunks.
+
+Queries are the section prompts of the bundled UK ICO template, candidates are
+~4000 character chunks of chatData/data.txt, the same shape generate_dpia feeds
+the reranker. Reports per-query latency, pair throughput and top-10 agreement.
+
+    python benchmarks/rerank_backends.py --candidates 20 --queries 20
+"""
+import os, sys, json, time, argparse, statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rerank import Reranker, OnnxReranker
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_queries(limit):
+    with open(os.path.join(BASE_DIR, "template", "UK ICO (Default).txt"), "r") as file:
+        template = json.load(file)
+    prompts = [part["content"] for step in template.values() for part in step.values() if part["content"].strip()]
+    return prompts[:limit]
+
+def load_chunks(size=4000):
+    with open(os.path.join(BASE_DIR, "chatData", "data.txt"), "r") as file:
+        text = file.read()
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+def run(backend, groups, repeat):
+    backend.load() # warm-up, model loading is not part of the measurement
+    backend.rank_batch(groups[:1])
+    latencies = []
+    results = None
+    began = time.time()
+    for _ in range(repeat):
+        results = []
+        for query, documents in groups:
+            start = time.time()
+            results.append(backend.rank(query, documents))
+            latencies.append(time.time() - start)
+    elapsed = time.time() - began
+    pairs = sum(len(documents) for _, documents in groups) * repeat
+    latencies.sort()
+    return results, {
+        "p50_ms": round(statistics.median(latencies) * 1000, 1),
+        "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 1),
+        "pairs_per_s": round(pairs / elapsed, 1),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--candidates", type=int, default=20, help="candidates per query")
+    parser.add_argument("--queries", type=int, default=20, help="number of template prompts")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    chunks = load_chunks()
+    queries = load_queries(args.queries)
+    # rotate through the chunks so every query sees a different candidate set
+    groups = [(query, [chunks[(i + j) % len(chunks)] for j in range(args.candidates)]) for i, query in enumerate(queries)]
+
+    torch_results, torch_stats = run(Reranker(), groups, args.repeat)
+    onnx_results, onnx_stats = run(OnnxReranker(), groups, args.repeat)
+
+    agreement = [len(set(a) & set(b)) / max(len(a), 1) for a, b in zip(torch_results, onnx_results)]
+    top1 = [a[:1] == b[:1] for a, b in zip(torch_results, onnx_results)]
+    print(f"{len(groups)} queries x {args.candidates} candidates, {args.repeat} repeats")
+    print(f"torch    {torch_stats}")
+    print(f"onnx int8 {onnx_stats}")
+    print(f"speed-up (p50): {torch_stats['p50_ms'] / onnx_stats['p50_ms']:.2f}x")
+    print(f"top-10 agreement: {statistics.mean(agreement):.3f}, top-1 agreement: {sum(top1) / len(top1):.3f}")
+
+
+if __name__ == "__main__":
+    main()
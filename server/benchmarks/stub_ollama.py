@@ -0,0 +1,137 @@
+"""Stand-in Ollama server for benchmarks, answering /api/chat and /api/embeddings.
+
+Chat answers arrive after --latency-ms and stream at --tokens-per-s, so the
+time spent in LLM calls is controlled and repeatable. Embeddings are hashed
+bags of words, similar texts get similar vectors and retrieval stays
+meaningful. Counts calls, prompt and completion tokens per model.
+
+    python benchmarks/stub_ollama.py --port 11434 --latency-ms 200 --tokens-per-s 40
+"""
+import re, json, time, zlib, math, argparse, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import tiktoken
+
+WORDS = ("the controller processes personal data for a specified and lawful purpose with appropriate safeguards "
+         "including data minimisation retention limits access controls encryption and regular review of risks to "
+         "individuals whose rights and freedoms are protected by the organisation").split()
+
+
+class StubStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.models = {}
+
+    def add(self, model, **counts):
+        with self.lock:
+            stats = self.models.setdefault(model, {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0})
+            for name, value in counts.items():
+                stats[name] += value
+
+    def snapshot(self):
+        with self.lock:
+            return {model: dict(stats) for model, stats in self.models.items()}
+
+
+class StubOllama(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.2, tokens_per_s=40.0, answer_tokens=150, embed_latency=0.005, dim=768):
+        super().__init__(address, StubHandler)
+        self.latency = latency
+        self.tokens_per_s = tokens_per_s
+        self.answer_tokens = answer_tokens
+        self.embed_latency = embed_latency
+        self.dim = dim
+        self.stats = StubStats()
+        self.encoding = tiktoken.get_encoding("cl100k_base")
+
+    def answer(self, prompt):
+        # The shape of the answer follows what the caller parses
+        if "'Role', and a 'Backstory'" in prompt: # role assignment chain, parsed with json.loads
+            return json.dumps({"Role": "DPIA Analyst", "Backstory": "An experienced privacy professional."})
+        text = " ".join(WORDS[i % len(WORDS)] for i in range(self.answer_tokens))
+        if "Final Answer:" in prompt: # CrewAI agents only accept a final answer in this format
+            return f"Thought: I now can give a great answer\nFinal Answer: {text}"
+        return text
+
+    def embed(self, text):
+        vector = [0.0] * self.dim
+        for token in re.findall(r"\w+", text.lower()):
+            vector[zlib.crc32(token.encode()) % self.dim] += 1.0
+        norm = math.sqrt(sum(v * v for v in vector)) or 1.0
+        return [v / norm for v in vector]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def _json(self, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/api/tags":
+            return self._json({"models": []})
+        self.send_error(404)
+
+    def do_POST(self):
+        server = self.server
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        model = request.get("model", "")
+        start = time.time()
+        if self.path == "/api/embeddings":
+            time.sleep(server.embed_latency)
+            server.stats.add(model, calls=1, prompt_tokens=len(server.encoding.encode(request.get("prompt", ""), disallowed_special=())),
+                             seconds=time.time() - start)
+            return self._json({"embedding": server.embed(request.get("prompt", ""))})
+        if self.path != "/api/chat":
+            return self.send_error(404)
+
+        prompt = "\n".join(message.get("content", "") for message in request.get("messages", []))
+        tokens = [server.encoding.decode([token]) for token in server.encoding.encode(server.answer(prompt))]
+        time.sleep(server.latency)
+        if request.get("stream", True):
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            for token in tokens:
+                time.sleep(1.0 / server.tokens_per_s)
+                self.wfile.write((json.dumps({"model": model, "message": {"role": "assistant", "content": token}, "done": False}) + "\n").encode())
+                self.wfile.flush()
+            self.wfile.write((json.dumps({"model": model, "message": {"role": "assistant", "content": ""}, "done": True,
+                                          "prompt_eval_count": len(server.encoding.encode(prompt, disallowed_special=())),
+                                          "eval_count": len(tokens)}) + "\n").encode())
+        else:
+            time.sleep(len(tokens) / server.tokens_per_s)
+            self._json({"model": model, "message": {"role": "assistant", "content": "".join(tokens)}, "done": True})
+        server.stats.add(model, calls=1, prompt_tokens=len(server.encoding.encode(prompt, disallowed_special=())),
+                         completion_tokens=len(tokens), seconds=time.time() - start)
+
+
+def serve(port=11434, **options):
+    # Start the server on a background thread and return it
+    server = StubOllama(("127.0.0.1", port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--latency-ms", type=float, default=200, help="time to first token of a chat call")
+    parser.add_argument("--tokens-per-s", type=float, default=40)
+    parser.add_argument("--answer-tokens", type=int, default=150)
+    parser.add_argument("--embed-latency-ms", type=float, default=5)
+    args = parser.parse_args()
+    server = StubOllama(("127.0.0.1", args.port), latency=args.latency_ms / 1000, tokens_per_s=args.tokens_per_s,
+                        answer_tokens=args.answer_tokens, embed_latency=args.embed_latency_ms / 1000)
+    print(f"Stub Ollama listening on 127.0.0.1:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print(json.dumps(server.stats.snapshot(), indent=2))
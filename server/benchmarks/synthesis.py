@@ -0,0 +1,90 @@
+"""Compare the refine and map-reduce answer synthesis modes against a local Ollama.
+
+Queries are the section prompts of the bundled UK ICO template, the context of
+each is a slice of chatData/data.txt of --context characters, cut into
+paragraphs and packed by pack_context as generate_dpia does. Reports the wall
+time, LLM calls and output length of both modes for every query.
+
+    python benchmarks/synthesis.py --queries 5 --context 20000 --workers 2
+"""
+import os, sys, json, time, argparse, statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from langchain_community.chat_models import ChatOllama
+from crewai import Agent
+import helper
+from helper import synthesise_response, token_counter, prompt_tokens, pack_context
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_queries(limit):
+    with open(os.path.join(BASE_DIR, "template", "UK ICO (Default).txt"), "r") as file:
+        template = json.load(file)
+    prompts = [part["content"] for step in template.values() for part in step.values() if part["content"].strip()]
+    return prompts[:limit]
+
+def load_text():
+    with open(os.path.join(BASE_DIR, "chatData", "data.txt"), "r") as file:
+        return file.read()
+
+def run(mode, agent, prompt, context, workers):
+    describe = lambda previous, content: (f"""Based on the provided context: {previous}\n {content}\n
+                                        Provide a detailed answer to the prompt: {prompt}.
+                                        References and citations are not relevant.""")
+    counter = token_counter(agent.llm.model)
+    split_content, _ = pack_context(context.split("\n\n"), counter, prompt_tokens(counter, describe, agent))
+    calls = []
+    answer_chunk = helper.answer_chunk
+    helper.answer_chunk = lambda *args: calls.append(1) or answer_chunk(*args) # count the LLM calls of both modes
+    try:
+        start = time.time()
+        answer = synthesise_response(mode, split_content, describe,
+                                     f"""Return an accurate and coherent response in a professional tone.""",
+                                     prompt, agent, workers)
+        elapsed = time.time() - start
+    finally:
+        helper.answer_chunk = answer_chunk
+    calls = len(calls)
+    return {"seconds": round(elapsed, 1), "calls": calls, "chars": len(answer), "words": len(answer.split())}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=5, help="number of template prompts")
+    parser.add_argument("--context", type=int, default=20000, help="context characters per query")
+    parser.add_argument("--workers", type=int, default=2, help="concurrent map calls, match OLLAMA_NUM_PARALLEL")
+    parser.add_argument("--model", default="gemma2")
+    args = parser.parse_args()
+
+    text = load_text()
+    agent = Agent(
+        role="DPIA writer",
+        goal="Provide a professional response based on the provided context.",
+        backstory="A professional with experience in writing DPIA reports.",
+        llm=ChatOllama(model=args.model, temperature=0.0, num_ctx=8000),
+        allow_delegation=False,
+        verbose=False
+    )
+
+    results = {"refine": [], "map_reduce": []}
+    for i, prompt in enumerate(load_queries(args.queries)):
+        # rotate through the knowledge base so every query sees a different context
+        offset = (i * args.context) % max(len(text) - args.context, 1)
+        context = text[offset:offset + args.context]
+        for mode in results:
+            result = run(mode, agent, prompt, context, args.workers)
+            results[mode].append(result)
+            print(f"query {i + 1} {mode:<10} {result}")
+
+    print(f"{args.queries} queries, {args.context} context characters, {args.workers} map workers")
+    for mode, rows in results.items():
+        print(f"{mode:<10} mean {statistics.mean(r['seconds'] for r in rows):.1f}s, "
+              f"{statistics.mean(r['calls'] for r in rows):.1f} calls, "
+              f"{statistics.mean(r['words'] for r in rows):.0f} words")
+    refine = statistics.mean(r['seconds'] for r in results["refine"])
+    map_reduce = statistics.mean(r['seconds'] for r in results["map_reduce"])
+    print(f"speed-up: {refine / map_reduce:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""Latency and recall of summary_<user> collections as they grow.
+
+Builds collections of --sizes documents with the metadata schema ingestion
+writes (doc_id, file_name, embed_type, usage), either synthetic (clustered
+768-d vectors, one cluster per file, like nomic-embed-text summaries of a few
+documents) or recorded from an existing user with --user. Every collection is
+built once per HNSW setting and queried with the filters the app uses:
+
+    chat     {"$and": [{"file_name": f}, {"usage": "chat"}]}       get_msg
+    project  {"$and": [{"file_name": f}, {"usage": "project_1"}]}  generate_dpia, per file
+    usage    {"usage": "project_1"}                                bulk delete, all files
+
+Recall@k is measured against a brute-force search of the same filtered
+subset with the collection's distance (l2, the langchain_chroma default).
+
+    python benchmarks/vector_retrieval.py --sizes 500 5000 20000 --M 16 32 --ef 10 50 100
+"""
+import os, time, uuid, argparse, statistics, tempfile, shutil
+import numpy as np
+import chromadb
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def synthetic(size, files, dim, seed):
+    # Every file is a cluster of summaries around its own topic vector, split between a chat and a project scope
+    rng = np.random.default_rng(seed)
+    centres = rng.normal(size=(files, dim))
+    owners = rng.integers(0, files, size)
+    vectors = centres[owners] + rng.normal(scale=0.6, size=(size, dim))
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    kinds = rng.choice(["text", "table", "image"], size, p=[0.8, 0.15, 0.05])
+    metadatas = [{"doc_id": str(uuid.uuid4()), "file_name": f"file_{owner}.pdf", "embed_type": str(kind),
+                  "usage": "chat" if owner == 0 else "project_1"} for owner, kind in zip(owners, kinds)]
+    return vectors.astype(np.float32), metadatas
+
+def recorded(user_id, size, seed):
+    # Embeddings and metadata of an existing user's collection, repeated with small noise up to size
+    client = chromadb.PersistentClient(path=os.path.join(BASE_DIR, "vectorDB"))
+    found = client.get_collection(f"summary_{user_id}").get(include=["embeddings", "metadatas"])
+    base = np.array(found["embeddings"], dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    picks = rng.integers(0, len(base), size)
+    vectors = base[picks] + rng.normal(scale=0.01, size=(size, base.shape[1])).astype(np.float32)
+    metadatas = [dict(found["metadatas"][i], doc_id=str(uuid.uuid4())) for i in picks]
+    return vectors, metadatas
+
+def filters(metadatas):
+    chat_file = next((m["file_name"] for m in metadatas if m["usage"] == "chat"), None)
+    project_file = next((m["file_name"] for m in metadatas if m["usage"] != "chat"), None)
+    project = next((m["usage"] for m in metadatas if m["usage"] != "chat"), None)
+    cases = {}
+    if chat_file:
+        cases["chat"] = {"$and": [{"file_name": chat_file}, {"usage": "chat"}]}
+    if project_file:
+        cases["project"] = {"$and": [{"file_name": project_file}, {"usage": project}]}
+        cases["usage"] = {"usage": project}
+    return cases
+
+def matches(metadata, where):
+    if "$and" in where:
+        return all(matches(metadata, clause) for clause in where["$and"])
+    return all(metadata.get(key) == value for key, value in where.items())
+
+def build(client, vectors, metadatas, M, ef, construction_ef):
+    name = f"bench_{uuid.uuid4().hex[:8]}"
+    collection = client.create_collection(name, metadata={"hnsw:space": "l2", "hnsw:M": M, "hnsw:search_ef": ef,
+                                                           "hnsw:construction_ef": construction_ef})
+    start = time.time()
+    for i in range(0, len(vectors), 5000):
+        collection.add(ids=[str(j) for j in range(i, min(i + 5000, len(vectors)))],
+                       embeddings=vectors[i:i + 5000].tolist(), metadatas=metadatas[i:i + 5000])
+    return collection, time.time() - start
+
+def run(collection, vectors, metadatas, where, queries, k):
+    subset = np.array([i for i, m in enumerate(metadatas) if matches(m, where)])
+    latencies, recalls = [], []
+    for query in queries:
+        start = time.time()
+        result = collection.query(query_embeddings=[query.tolist()], n_results=k, where=where, include=[])
+        latencies.append(time.time() - start)
+        distances = np.linalg.norm(vectors[subset] - query, axis=1)
+        truth = {str(i) for i in subset[np.argsort(distances)[:k]]}
+        recalls.append(len(truth & set(result["ids"][0])) / max(min(k, len(subset)), 1))
+    latencies.sort()
+    return {"docs": len(subset), "p50_ms": round(statistics.median(latencies) * 1000, 2),
+            "p95_ms": round(latencies[int(len(latencies) * 0.95) - 1] * 1000, 2), "recall": round(statistics.mean(recalls), 3)}
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[500, 5000, 20000])
+    parser.add_argument("--M", type=int, nargs="+", default=[16], help="HNSW graph degree (chroma default 16)")
+    parser.add_argument("--ef", type=int, nargs="+", default=[10], help="HNSW search ef (chroma default 10)")
+    parser.add_argument("--construction-ef", type=int, default=100)
+    parser.add_argument("--files", type=int, default=12, help="files per synthetic collection")
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=20, help="k of the retrievers in partition_process")
+    parser.add_argument("--user", help="replicate the recorded collection of this user instead of synthetic data")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    path = tempfile.mkdtemp(prefix="vector_retrieval_")
+    try:
+        client = chromadb.PersistentClient(path=path)
+        print("size   M   ef  filter   docs  p50_ms  p95_ms  recall@k  build_s")
+        for size in args.sizes:
+            vectors, metadatas = recorded(args.user, size, args.seed) if args.user else synthetic(size, args.files, args.dim, args.seed)
+            rng = np.random.default_rng(args.seed + 1)
+            # queries close to stored summaries, as a section prompt is close to the summaries it should find
+            queries = vectors[rng.integers(0, size, args.queries)] + rng.normal(scale=0.02, size=(args.queries, vectors.shape[1])).astype(np.float32)
+            for M in args.M:
+                for ef in args.ef:
+                    collection, built = build(client, vectors, metadatas, M, ef, args.construction_ef)
+                    for case, where in filters(metadatas).items():
+                        stats = run(collection, vectors, metadatas, where, queries, args.k)
+                        print(f"{size:<6} {M:<3} {ef:<4} {case:<8} {stats['docs']:<5} {stats['p50_ms']:<7} {stats['p95_ms']:<7} {stats['recall']:<9} {built:.1f}")
+                    client.delete_collection(collection.name)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+import os, json, math, time, sqlite3, hashlib
+from array import array
+from contextlib import contextmanager
+from langchain_core.embeddings import Embeddings
+
+
+def text_digest(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+def file_digest(path, block_size=1 << 20):
+    # Hash the file in blocks so large PDFs are never read into memory at once
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for block in iter(lambda: file.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def pack_vectors(vectors):
+    # Store embeddings as a flat float32 array, half the size of float64 and far smaller than JSON
+    flat = array("f")
+    for vector in vectors:
+        flat.extend(vector)
+    return flat.tobytes()
+
+def unpack_vectors(blob, count):
+    flat = array("f")
+    flat.frombytes(blob)
+    if count == 0:
+        return []
+    dim = len(flat) // count
+    return [flat[i * dim:(i + 1) * dim].tolist() for i in range(count)]
+
+
+class SQLiteCache:
+    # Base class for the on-disk caches, every entry table has key, size, created and accessed columns
+    # A connection is opened per operation so instances are safe to share across threads and forked Celery workers
+    tables = []
+
+    def __init__(self, path, max_bytes=None, max_age=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            for table in self.tables:
+                conn.execute(table)
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _count(self, conn, name, amount=1):
+        conn.execute("INSERT INTO stats (name, value) VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + ?", (name, amount, amount))
+
+    def _touch(self, conn, table, key):
+        conn.execute(f"UPDATE {table} SET accessed = ? WHERE key = ?", (time.time(), key))
+
+    def _evict(self, conn, table):
+        if self.max_age is not None:
+            conn.execute(f"DELETE FROM {table} WHERE accessed < ?", (time.time() - self.max_age,))
+        if self.max_bytes is not None:
+            total = conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM {table}").fetchone()[0]
+            if total > self.max_bytes:
+                # Drop the least recently used entries until the table fits the size budget
+                stale = []
+                for key, size in conn.execute(f"SELECT key, size FROM {table} ORDER BY accessed ASC"):
+                    if total <= self.max_bytes:
+                        break
+                    stale.append((key,))
+                    total -= size
+                conn.executemany(f"DELETE FROM {table} WHERE key = ?", stale)
+
+    def stats(self):
+        with self._connect() as conn:
+            stats = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+        for name in {key.rsplit("_", 1)[0] for key in stats}:
+            lookups = stats.get(f"{name}_hits", 0) + stats.get(f"{name}_misses", 0)
+            if lookups:
+                stats[f"{name}_hit_rate"] = round(stats.get(f"{name}_hits", 0) / lookups, 3)
+        return stats
+
+
+class IngestCache(SQLiteCache):
+    # Content-addressed cache of ingestion output
+    # files: partitioned chunks, summaries, image descriptions and their embeddings, keyed by the file content hash
+    # images: description and embedding of a single image, so images repeated across files are captioned once
+    tables = [
+        "CREATE TABLE IF NOT EXISTS files (key TEXT PRIMARY KEY, entries TEXT NOT NULL, vectors BLOB NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS images (key TEXT PRIMARY KEY, description TEXT NOT NULL, vector BLOB NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)",
+    ]
+
+    def get_file(self, key):
+        # Return (entries, vectors) where entries is a list of [embed_type, raw, summary], or None
+        with self._connect() as conn:
+            row = conn.execute("SELECT entries, vectors FROM files WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._count(conn, "file_misses")
+                return None
+            self._count(conn, "file_hits")
+            self._touch(conn, "files", key)
+        entries = json.loads(row[0])
+        return entries, unpack_vectors(row[1], len(entries))
+
+    def put_file(self, key, entries, vectors):
+        entries = json.dumps(entries)
+        blob = pack_vectors(vectors)
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)", (key, entries, blob, len(entries) + len(blob), now, now))
+            self._evict(conn, "files")
+
+    def get_image(self, key):
+        # Return (description, vector) or None
+        with self._connect() as conn:
+            row = conn.execute("SELECT description, vector FROM images WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self._count(conn, "image_misses")
+                return None
+            self._count(conn, "image_hits")
+            self._touch(conn, "images", key)
+        return row[0], unpack_vectors(row[1], 1)[0]
+
+    def put_images(self, items):
+        # items: list of (key, description, vector)
+        now = time.time()
+        rows = []
+        for key, description, vector in items:
+            blob = pack_vectors([vector])
+            rows.append((key, description, blob, len(description) + len(blob), now, now))
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._evict(conn, "images")
+
+
+class SummaryCache(SQLiteCache):
+    # Durable cache of chunk summaries, so re-ingesting a revised document only summarises the changed chunks
+    tables = [
+        "CREATE TABLE IF NOT EXISTS summaries (key TEXT PRIMARY KEY, summary TEXT NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)",
+    ]
+
+    @staticmethod
+    def key(chunk, prompt, model, temperature):
+        # A summary is only reusable for the same chunk text, prompt, model and temperature
+        return text_digest(f"{text_digest(chunk)}|{text_digest(prompt)}|{model}|{temperature}")
+
+    def get_many(self, keys):
+        # Return {key: summary} for the keys found in the cache
+        found = {}
+        with self._connect() as conn:
+            for key in set(keys):
+                row = conn.execute("SELECT summary FROM summaries WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    found[key] = row[0]
+                    self._touch(conn, "summaries", key)
+            hits = sum(1 for key in keys if key in found)
+            self._count(conn, "summary_hits", hits)
+            self._count(conn, "summary_misses", len(keys) - hits)
+        return found
+
+    def put_many(self, summaries):
+        now = time.time()
+        rows = [(key, summary, len(summary), now, now) for key, summary in summaries.items()]
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?, ?)", rows)
+            self._evict(conn, "summaries")
+
+
+class EmbeddingCache(SQLiteCache):
+    # LRU cache of embedding vectors keyed by model, kind (document or query) and text hash
+    tables = [
+        "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)",
+    ]
+
+    @staticmethod
+    def key(model, kind, text):
+        return text_digest(f"{model}|{kind}|{text_digest(text)}")
+
+    def get_many(self, keys):
+        # Return {key: vector} for the keys found in the cache
+        found = {}
+        with self._connect() as conn:
+            for key in set(keys):
+                row = conn.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    found[key] = unpack_vectors(row[0], 1)[0]
+                    self._touch(conn, "embeddings", key)
+            hits = sum(1 for key in keys if key in found)
+            self._count(conn, "embedding_hits", hits)
+            self._count(conn, "embedding_misses", len(keys) - hits)
+            if keys and hits == len(keys):
+                self._count(conn, "requests_saved")
+        return found
+
+    def put_many(self, vectors):
+        now = time.time()
+        rows = []
+        for key, vector in vectors.items():
+            blob = pack_vectors([vector])
+            rows.append((key, blob, len(blob), now, now))
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?)", rows)
+            self._evict(conn, "embeddings")
+
+
+class CachedEmbeddings(Embeddings):
+    # Embedding function that serves document and query embeddings from an EmbeddingCache
+    # and only sends texts it has not seen before to the wrapped model
+
+    def __init__(self, embeddings, cache):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = getattr(embeddings, "model", type(embeddings).__name__)
+
+    def _embed(self, kind, texts, embed):
+        keys = [EmbeddingCache.key(self.model, kind, text) for text in texts]
+        vectors = self.cache.get_many(keys)
+        missing = {key: text for key, text in zip(keys, texts) if key not in vectors}
+        if missing:
+            computed = dict(zip(missing.keys(), embed(list(missing.values()))))
+            self.cache.put_many(computed)
+            vectors.update(computed)
+        return [vectors[key] for key in keys]
+
+    def embed_documents(self, texts):
+        return self._embed("document", texts, self.embeddings.embed_documents)
+
+    def remember(self, texts, vectors):
+        # Store document embeddings computed elsewhere, e.g. linked from the ingest cache, so embedding them is a lookup
+        self.cache.put_many({EmbeddingCache.key(self.model, "document", text): vector for text, vector in zip(texts, vectors)})
+
+    def embed_query(self, text):
+        return self._embed("query", [text], lambda texts: [self.embeddings.embed_query(texts[0])])[0]
+
+
+class AnswerCache(SQLiteCache):
+    # Chat answers keyed by scope (user, document, model, synthesis and retrieval mode) and the embedding of the question
+    # A stored answer is returned for a new question whose embedding is similar enough, until it is older than the TTL
+    tables = [
+        "CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, user TEXT NOT NULL, scope TEXT NOT NULL, query TEXT NOT NULL, vector BLOB NOT NULL, answer TEXT NOT NULL, size INTEGER NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS answers_scope ON answers (scope)",
+        "CREATE INDEX IF NOT EXISTS answers_user ON answers (user)",
+    ]
+
+    def __init__(self, path, threshold=0.95, ttl=24 * 3600, max_bytes=None):
+        super().__init__(path, max_bytes=max_bytes)
+        self.threshold = threshold
+        self.ttl = ttl
+
+    @staticmethod
+    def scope(user_id, document, model, synthesis, retrieval):
+        # an answer built with another synthesis or retrieval mode is not served for the same question
+        return f"{user_id}|{document}|{model}|{synthesis}|{retrieval}"
+
+    @staticmethod
+    def similarity(a, b):
+        dot = sum(x * y for x, y in zip(a, b))
+        norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+        return dot / norm if norm else 0.0
+
+    def get(self, scope, vector):
+        # Return (answer, similarity) of the most similar question answered in the scope, or None below the threshold
+        with self._connect() as conn:
+            rows = conn.execute("SELECT key, vector, answer FROM answers WHERE scope = ? AND created >= ?", (scope, time.time() - self.ttl)).fetchall()
+            best = None
+            for key, blob, answer in rows:
+                score = self.similarity(vector, unpack_vectors(blob, 1)[0])
+                if score >= self.threshold and (best is None or score > best[2]):
+                    best = (key, answer, score)
+            if best is None:
+                self._count(conn, "answer_misses")
+                return None
+            self._count(conn, "answer_hits")
+            self._touch(conn, "answers", best[0])
+        return best[1], best[2]
+
+    def put(self, user_id, scope, query, vector, answer):
+        blob = pack_vectors([vector])
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (text_digest(f"{scope}|{query}"), str(user_id), scope, query, blob, answer, len(query) + len(blob) + len(answer), now, now))
+            conn.execute("DELETE FROM answers WHERE created < ?", (now - self.ttl,))
+            self._evict(conn, "answers")
+
+    def invalidate(self, user_id):
+        # Drop every answer of the user, called when their chat documents are cleared
+        with self._connect() as conn:
+            conn.execute("DELETE FROM answers WHERE user = ?", (str(user_id),))
@@ -0,0 +1,189 @@
+"""Parent document store kept in one SQLite file per store directory.
+
+Replaces LocalFileStore + create_kv_docstore, which keeps one file per parent
+chunk. Documents are serialised the same way, so a directory written by
+LocalFileStore is migrated by copying its files into the database:
+
+    python docstore.py vectorDB/parentData chatData/parentData
+
+The server runs the same migration once per process when it starts, stores are
+then opened without looking for LocalFileStore files.
+"""
+import os, sys, fcntl, sqlite3, threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from langchain_core.documents import Document
+from langchain_core.load import dumps, loads
+from langchain_core.stores import BaseStore
+
+DB_NAME = "parents.sqlite3"
+# roots already migrated by this process
+MIGRATED_ROOTS = set()
+# files in a store directory that are not parent documents
+RESERVED = {DB_NAME, DB_NAME + "-journal", ".ingest_state.json", ".ingest.lock", ".migrate.lock"}
+
+
+class DocumentLRU:
+    # Hot parent documents of every store of the process, keyed by (database path, document id)
+    def __init__(self, max_items=2048):
+        self.max_items = max_items
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            doc = self.items.get(key)
+            if doc is not None:
+                self.items.move_to_end(key)
+            return doc
+
+    def put(self, key, doc):
+        with self.lock:
+            self.items[key] = doc
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+
+    def discard(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+
+document_lru = DocumentLRU(int(os.getenv("DOCSTORE_LRU_ITEMS", 2048)))
+
+
+class SQLiteDocStore(BaseStore[str, Document]):
+    # mget/mset/mdelete/yield_keys store of parent documents used by MultiVectorRetriever and ParentDocumentRetriever
+    # A connection is opened per operation so instances are safe to share across threads and forked Celery workers
+    def __init__(self, store_path, lru=document_lru):
+        os.makedirs(store_path, exist_ok=True)
+        self.path = os.path.join(store_path, DB_NAME)
+        self.lru = lru
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS documents (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+    def mget(self, keys):
+        found = {}
+        missing = []
+        for key in keys:
+            doc = self.lru.get((self.path, key))
+            if doc is not None:
+                found[key] = doc
+            else:
+                missing.append(key)
+        if missing:
+            with self._connect() as conn:
+                # stay under SQLite's limit of host parameters per statement
+                for start in range(0, len(missing), 500):
+                    batch = missing[start:start + 500]
+                    rows = conn.execute(f"SELECT key, value FROM documents WHERE key IN ({','.join('?' * len(batch))})", batch).fetchall()
+                    for key, value in rows:
+                        found[key] = loads(value)
+                        self.lru.put((self.path, key), found[key])
+        return [found.get(key) for key in keys]
+
+    def mset(self, key_value_pairs):
+        pairs = list(key_value_pairs)
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO documents VALUES (?, ?)", [(key, dumps(doc)) for key, doc in pairs])
+        for key, doc in pairs:
+            self.lru.put((self.path, key), doc)
+
+    def mset_raw(self, key_value_pairs):
+        # Store already serialised documents, as written by create_kv_docstore
+        with self._connect() as conn:
+            conn.executemany("INSERT OR REPLACE INTO documents VALUES (?, ?)", key_value_pairs)
+        for key, _ in key_value_pairs:
+            self.lru.discard((self.path, key))
+
+    def mdelete(self, keys):
+        keys = list(keys)
+        with self._connect() as conn:
+            conn.executemany("DELETE FROM documents WHERE key = ?", [(key,) for key in keys])
+        for key in keys:
+            self.lru.discard((self.path, key))
+
+    def yield_keys(self, prefix=None):
+        with self._connect() as conn:
+            if prefix is None:
+                rows = conn.execute("SELECT key FROM documents").fetchall()
+            else:
+                rows = conn.execute("SELECT key FROM documents WHERE substr(key, 1, ?) = ?", (len(prefix), prefix)).fetchall()
+        for (key,) in rows:
+            yield key
+
+
+def legacy_files(store_path):
+    # Return {key: file path} of the documents LocalFileStore wrote to the directory
+    files = {}
+    if not os.path.isdir(store_path):
+        return files
+    for root, _, names in os.walk(store_path):
+        for name in names:
+            path = os.path.join(root, name)
+            if root == store_path and name in RESERVED:
+                continue
+            files[os.path.relpath(path, store_path)] = path
+    return files
+
+def migrate_store(store_path):
+    # Move the documents of a LocalFileStore directory into its SQLite store, return the number moved
+    if not legacy_files(store_path):
+        return 0
+    with open(os.path.join(store_path, ".migrate.lock"), "w") as lock:
+        # another worker may be migrating the same directory, the files are listed again once it has finished
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        files = legacy_files(store_path)
+        if not files:
+            return 0
+        store = SQLiteDocStore(store_path)
+        pairs = []
+        for key, path in files.items():
+            with open(path, "r", encoding="utf-8") as file:
+                pairs.append((key, file.read()))
+        store.mset_raw(pairs)
+        for path in files.values():
+            os.remove(path)
+        # remove the directories of nested keys, now empty
+        for root, dirs, _ in os.walk(store_path, topdown=False):
+            for name in dirs:
+                directory = os.path.join(root, name)
+                if not os.listdir(directory):
+                    os.rmdir(directory)
+    return len(pairs)
+
+def open_docstore(store_path):
+    # Open the parent document store of a directory, LocalFileStore documents are moved in by migrate_roots
+    return SQLiteDocStore(store_path)
+
+def migrate_roots(roots):
+    # Migrate every LocalFileStore directory under the roots, a root is walked at most once per process
+    for root in roots:
+        if root in MIGRATED_ROOTS:
+            continue
+        for directory in store_directories(root):
+            migrated = migrate_store(directory)
+            if migrated:
+                print(f"Migrated {migrated} parent documents into {os.path.join(directory, DB_NAME)}")
+        MIGRATED_ROOTS.add(root)
+
+def store_directories(root):
+    # Directories under root holding LocalFileStore documents, the parent of a store's nested keys is not one
+    directories = []
+    for directory, _, names in os.walk(root):
+        if any(name not in RESERVED for name in names) and not any(directory.startswith(d + os.sep) for d in directories):
+            directories.append(directory)
+    return directories
+
+
+if __name__ == "__main__":
+    migrate_roots(sys.argv[1:] or ["vectorDB/parentData", "chatData/parentData"])
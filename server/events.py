@@ -0,0 +1,87 @@
+import json, time
+import redis
+from langchain_core.callbacks import BaseCallbackHandler
+
+
+class TaskEvents:
+    # Progress events of Celery tasks, kept in a Redis list for replay and published on a channel for live readers
+    def __init__(self, url, ttl=24 * 3600):
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+
+    def publish(self, task_id, event, data):
+        key = f"task_events:{task_id}"
+        # the list length is the event id, readers use it to skip events they already replayed
+        event_id = self.client.rpush(key, json.dumps({"event": event, "data": data}))
+        self.client.expire(key, self.ttl)
+        self.client.publish(key, json.dumps({"id": event_id, "event": event, "data": data}))
+
+    def stream(self, task_id, finished, keepalive=15):
+        # Yield server-sent events for the task, first the ones already published, then live ones,
+        # until a done or error event arrives or the task has finished without one
+        key = f"task_events:{task_id}"
+        pubsub = self.client.pubsub()
+        pubsub.subscribe(key)
+        try:
+            last_id = 0
+            for raw in self.client.lrange(key, 0, -1):
+                last_id += 1
+                message = json.loads(raw)
+                yield self.format(last_id, message)
+                if message["event"] in ("done", "error"):
+                    return
+            idle = time.time()
+            while True:
+                raw = pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if raw is None:
+                    if finished():
+                        return
+                    if time.time() - idle > keepalive:
+                        idle = time.time()
+                        yield ": keepalive\n\n"
+                    continue
+                message = json.loads(raw["data"])
+                if message["id"] <= last_id:
+                    continue
+                last_id = message["id"]
+                idle = time.time()
+                yield self.format(last_id, message)
+                if message["event"] in ("done", "error"):
+                    return
+        finally:
+            pubsub.close()
+
+    def finish(self, task_id):
+        # Announce that the result of the task is stored, to requests waiting for it
+        self.client.publish(f"task_finished:{task_id}", "")
+
+    def wait(self, task_id, finished, timeout):
+        # Block until finished() or timeout seconds have passed, woken by finish()
+        # Every caller subscribes on a connection of its own, a PubSub object must not be shared between threads
+        pubsub = self.client.pubsub()
+        pubsub.subscribe(f"task_finished:{task_id}")
+        try:
+            deadline = time.time() + timeout
+            # wait for the subscription to be confirmed before checking, so a task finishing in between is not missed
+            pubsub.get_message(timeout=min(timeout, 1.0))
+            while not finished():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+                pubsub.get_message(ignore_subscribe_messages=True, timeout=remaining)
+        finally:
+            pubsub.close()
+
+    @staticmethod
+    def format(event_id, message):
+        return f"id: {event_id}\nevent: {message['event']}\ndata: {json.dumps(message['data'])}\n\n"
+
+
+class TokenStream(BaseCallbackHandler):
+    # Publishes the tokens of an LLM as they are generated
+    def __init__(self, events, task_id):
+        self.events = events
+        self.task_id = task_id
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.events.publish(self.task_id, "token", token)
@@ -1,4 +1,8 @@
-import os, uuid, glob, shutil
+import os, uuid, shutil, multiprocessing, tempfile, threading, json, fcntl, math, fitz, tiktoken
+from functools import lru_cache
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from billiard.pool import Pool as BilliardPool
 from unstructured.partition.pdf import partition_pdf
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
@@ -18,34 +22,64 @@ from langchain_community.document_loaders import TextLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain.retrievers import ParentDocumentRetriever
 
-from langchain.storage import LocalFileStore
-from langchain.storage._lc_store import create_kv_docstore
-from visionLLM import image_response
+from docstore import open_docstore
+from stores import VectorStorePool
+from hybrid import MultiFileRetriever, lexical_index
+from visionLLM import image_responses, filter_images
+from cache import text_digest, file_digest, SummaryCache, CachedEmbeddings
 
 
 def check_path(path):
     if not os.path.exists(path):
         os.makedirs(path)
 
-def clear_chat_embed(vectorstore, user_id, BASE_DIR):
+def delete_embeddings(vectorstore, collection, where):
+    # Delete every embedding matching the metadata filter in one batched Chroma operation
+    vectorstore.delete(where=where)
+    lexical_index.invalidate(collection)
+
+def move_to_trash(BASE_DIR, paths):
+    # Move files and directories out of the way with a rename, which is instant, so their names can be reused at once
+    # Return the moved paths, to be removed by a background job
+    trash_dir = os.path.join(BASE_DIR, "trash")
+    check_path(trash_dir)
+    moved = []
+    for path in paths:
+        if os.path.exists(path):
+            target = os.path.join(trash_dir, uuid.uuid4().hex)
+            os.rename(path, target)
+            moved.append(target)
+            print(f"Removed: {path}")
+        else:
+            print(f"Does not exist: {path}")
+    return moved
+
+def remove_paths(paths):
+    # A path may already be gone, the trash sweep at worker start and a queued cleanup job can both list it
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+def clear_chat_embed(vectorstore, user_id, BASE_DIR, answer_cache=None):
+    # Delete the chat embeddings and move the chat files to the trash, return the moved paths
+    delete_embeddings(vectorstore, VectorStorePool.collection_name(user_id), {"usage": "chat"})
 
-    existing_documents = vectorstore.get(where={"usage": "chat"})['ids']
-    
     DIR_U = os.path.join(BASE_DIR, "uploads", str(user_id), "chat")
     DIR_F = os.path.join(BASE_DIR, "figures", str(user_id), "chat")
     DIR_FD = os.path.join(BASE_DIR, "figures", str(user_id), "chatDescription")
     DIR_P = os.path.join(BASE_DIR, "vectorDB", "parentData", str(user_id), "chat")
 
-    if len(existing_documents) > 0:
-        for ids in existing_documents:
-            vectorstore.delete(ids)
-    
-    for directory_path in [DIR_U, DIR_F, DIR_FD, DIR_P]:
-        if os.path.exists(directory_path) and os.path.isdir(directory_path):
-            shutil.rmtree(directory_path)
-            print(f"Removed directory: {directory_path}")
-        else:
-            print(f"Directory does not exist: {directory_path}")
+    moved = move_to_trash(BASE_DIR, [DIR_U, DIR_F, DIR_FD, DIR_P])
+
+    # cached answers were given about the documents just removed
+    if answer_cache is not None:
+        answer_cache.invalidate(user_id)
+    return moved
 
 def create_template(base_dir, session, filename):
     prepopulated_format = ""
@@ -68,48 +102,86 @@ def create_template(base_dir, session, filename):
     # Close the session
     session.close()
 
-def create_chatData(BASE_DIR, embeddings, msg):
-    BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-    file_path = os.path.join(BASE_DIR, f"chatData", "data.txt")
-
-    loaders = [
-        TextLoader(file_path),
-    ]
-    docs = []
-    for loader in loaders:
-        docs.extend(loader.load())
-    content = [Document(page_content=docs[0].page_content, metadata={"doc_id": "chatData"})]
-
-    # This text splitter is used to create the parent documents
-    parent_splitter = RecursiveCharacterTextSplitter(chunk_size=2500, chunk_overlap=100)
-    # This text splitter is used to create the child documents
-    # It should create documents smaller than the parent
-    child_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
-    # The vectorstore to use to index the child chunks
-    vectorstore = Chroma(
-        collection_name="chatData", embedding_function=embeddings, persist_directory=BASE_DIR + "/chatData/"
-    )
-    existing_documents = vectorstore.get()['ids']
-
-    # The storage layer for the parent documents
-    # store = InMemoryStore()
-    fs = LocalFileStore(BASE_DIR + "/chatData/" + "parentData")
-    store = create_kv_docstore(fs)
-
-    retriever = ParentDocumentRetriever(
-        vectorstore=vectorstore,
-        docstore=store,
-        id_key="doc_id",
-        child_splitter=child_splitter,
-        parent_splitter=parent_splitter,
-        search_kwargs={'k': 10}
-    )
-    if len(existing_documents) == 0:
-        retriever.add_documents(content)
-        retriever.docstore.mset(list(zip("chatData", content)))
-
-    context = retriever.invoke(msg)
-    return context
+class KnowledgeBase:
+    # The built-in chat knowledge base (chatData/data.txt), held as a warm retriever for the life of the worker process
+    # The index is rebuilt only when data.txt changes, the digest of the indexed version is kept next to it
+    # so worker processes and restarts agree on whether the persisted index is current
+    collection = "chatData"
+
+    def __init__(self, base_dir, embeddings):
+        self.dir = os.path.join(base_dir, "chatData")
+        self.file_path = os.path.join(self.dir, "data.txt")
+        self.state_path = os.path.join(self.dir, ".indexed")
+        self.embeddings = embeddings
+        self.retriever = None
+        self.mtime = None
+        self.lock = threading.Lock()
+
+    def _build(self):
+        # This text splitter is used to create the parent documents
+        parent_splitter = RecursiveCharacterTextSplitter(chunk_size=2500, chunk_overlap=100)
+        # This text splitter is used to create the child documents
+        # It should create documents smaller than the parent
+        child_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
+        # The vectorstore to use to index the child chunks
+        vectorstore = Chroma(
+            collection_name=self.collection, embedding_function=self.embeddings, persist_directory=self.dir + "/"
+        )
+        # The storage layer for the parent documents
+        store = open_docstore(os.path.join(self.dir, "parentData"))
+
+        return ParentDocumentRetriever(
+            vectorstore=vectorstore,
+            docstore=store,
+            id_key="doc_id",
+            child_splitter=child_splitter,
+            parent_splitter=parent_splitter,
+            search_kwargs={'k': 10}
+        )
+
+    def _index(self, retriever):
+        # Re-index data.txt if the persisted index is missing or was built from another version of it
+        with open(os.path.join(self.dir, ".index.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            digest = file_digest(self.file_path)
+            indexed = None
+            if os.path.exists(self.state_path):
+                with open(self.state_path, "r") as file:
+                    indexed = file.read().strip()
+            existing_documents = retriever.vectorstore.get(include=[])['ids']
+            if indexed is None and len(existing_documents) > 0:
+                # an index built before the digest was recorded, e.g. the one shipped with the repository
+                indexed = digest
+                with open(self.state_path, "w") as file:
+                    file.write(digest)
+            if digest == indexed and len(existing_documents) > 0:
+                return
+            print("Indexing the chat knowledge base")
+            if len(existing_documents) > 0:
+                retriever.vectorstore.delete(existing_documents)
+            stale = list(retriever.docstore.yield_keys())
+            if stale:
+                retriever.docstore.mdelete(stale)
+            docs = TextLoader(self.file_path).load()
+            retriever.add_documents([Document(page_content=docs[0].page_content, metadata={"doc_id": "chatData"})])
+            lexical_index.invalidate(self.collection)
+            with open(self.state_path, "w") as file:
+                file.write(digest)
+
+    def load(self):
+        # Return the warm retriever, only a changed data.txt costs more than a stat call
+        mtime = os.stat(self.file_path).st_mtime_ns
+        if self.retriever is not None and mtime == self.mtime:
+            return self.retriever
+        with self.lock:
+            if self.retriever is None or mtime != self.mtime:
+                retriever = self.retriever or self._build()
+                self._index(retriever)
+                self.retriever, self.mtime = retriever, mtime
+        return self.retriever
+
+    def invoke(self, msg):
+        return self.load().invoke(msg)
 
 
 def chat_dict(chatMessage):
@@ -123,28 +195,327 @@ class Element(BaseModel):
     type: str
     text: Any
 
-def partition_process(UP_DIR, user_id, project_id, filenames, IMG_DIR_C, IMG_DIR_CD, model, embeddings, filter, id_key, file_name, embed_type, usage, mode):
+def partition_file(file_path, img_dir, strategy="hi_res"):
+    # Runs in a worker process, so it only takes and returns plain picklable data
+    # Post processing to aggregate text once we have the title
+    # Chunking params to aggregate text blocks
+    # Attempt to create a new chunk 3800 chars
+    # Attempt to keep chunks > 2000 chars
+    # Hard max on chunks
+    chunking = dict(chunking_strategy="by_title", max_characters=4000, new_after_n_chars=3800, combine_text_under_n_chars=2000, overlap=200)
+    # Get PDF elements
+    if strategy == "fast":
+        # Text layer only, no layout model, for pages without images or tables
+        pdf_elements = partition_pdf(filename=file_path, strategy="fast", **chunking)
+    else:
+        pdf_elements = partition_pdf(
+            filename=file_path,
+            strategy="hi_res",
+            # Using pdf format to find embedded image blocks
+            extract_images_in_pdf=True,
+            # Use layout model (YOLOX) to get bounding boxes (for tables) and find titles
+            # Titles are any sub-section of the document
+            infer_table_structure=True,
+            extract_image_block_output_dir=img_dir,
+            **chunking
+        )
+    # Categorize by type
+    categorized_elements = []
+    for element in pdf_elements:
+        if "unstructured.documents.elements.Table" in str(type(element)):
+            categorized_elements.append(Element(type="table", text=str(element)))
+        elif "unstructured.documents.elements.CompositeElement" in str(type(element)):
+            categorized_elements.append(Element(type="text", text=str(element)))
+
+    # Text
+    texts = [e.text for e in categorized_elements if e.type == "text"]
+    # Tables
+    tables = [e.text for e in categorized_elements if e.type == "table"]
+    return texts, tables
+
+class BilliardExecutor:
+    # submit/shutdown over a billiard process pool, whose futures work with as_completed
+    # multiprocessing refuses to fork children from daemonic processes, billiard (Celery's fork of it) does not
+    def __init__(self, max_workers):
+        self.pool = BilliardPool(processes=max_workers)
+
+    def submit(self, func, *args):
+        future = Future()
+        self.pool.apply_async(func, args, callback=future.set_result, error_callback=future.set_exception)
+        return future
+
+    def shutdown(self, wait=True):
+        self.pool.close()
+        if wait:
+            self.pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.pool.terminate()
+        self.shutdown()
+
+def partition_executor(workers):
+    # Celery prefork workers are daemonic, partition there in a billiard pool so pages are still laid out in parallel processes
+    if multiprocessing.current_process().daemon:
+        return BilliardExecutor(workers)
+    return ProcessPoolExecutor(max_workers=workers)
+
+def partition_files(jobs, workers=1):
+    # Yield (filename, (texts, tables, strategies)) for each (filename, file_path, img_dir) job as soon as it is partitioned
+    if workers <= 1 or len(jobs) <= 1:
+        for filename, file_path, img_dir in jobs:
+            yield filename, partition_pages(file_path, img_dir)
+        return
+
+    with partition_executor(min(workers, len(jobs))) as pool:
+        futures = {pool.submit(partition_pages, file_path, img_dir): filename for filename, file_path, img_dir in jobs}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+def partition_window(file_path, img_dir, first, last, strategy="hi_res"):
+    # Copy the pages into a temporary PDF so the layout model only ever loads this window
+    fd, window_path = tempfile.mkstemp(suffix=".pdf")
+    os.close(fd)
+    try:
+        with fitz.open(file_path) as doc, fitz.open() as window:
+            window.insert_pdf(doc, from_page=first, to_page=last - 1)
+            window.save(window_path)
+        return partition_file(window_path, img_dir, strategy)
+    finally:
+        os.remove(window_path)
+
+def analyse_pages(file_path, first=0, last=None, min_chars=50, max_drawings=20):
+    # Return the partition strategy of each page in [first, last)
+    # Pages with a usable text layer and no raster images, vector figures or tables take the fast text-only path,
+    # scanned pages, figures and tables need hi_res layout inference
+    # Charts and diagrams drawn as vector paths have no image, a page with many drawings is sent to hi_res
+    # A few drawings are usually rules and cell borders, only then is the costly table detection run
+    strategies = []
+    with fitz.open(file_path) as doc:
+        for number in range(first, doc.page_count if last is None else last):
+            page = doc[number]
+            if len(page.get_text().strip()) < min_chars or page.get_images():
+                strategies.append("hi_res")
+                continue
+            drawings = len(page.get_drawings())
+            if drawings > max_drawings or (drawings and page.find_tables().tables):
+                strategies.append("hi_res")
+            else:
+                strategies.append("fast")
+    return strategies
+
+def partition_pages(file_path, img_dir, first=0, last=None):
+    # Partition pages [first, last), routing runs of consecutive pages to the strategy they need
+    # Returns texts, tables and the number of pages partitioned with each strategy
+    strategies = analyse_pages(file_path, first, last)
+    last = first + len(strategies)
+    runs = []
+    for number, strategy in enumerate(strategies, start=first):
+        if runs and runs[-1][2] == strategy:
+            runs[-1][1] = number + 1
+        else:
+            runs.append([number, number + 1, strategy])
+    report = {strategy: strategies.count(strategy) for strategy in set(strategies)}
+
+    if len(runs) == 1 and first == 0 and last == page_count(file_path):
+        return (*partition_file(file_path, img_dir, runs[0][2]), report)
+
+    texts, tables = [], []
+    for run_first, run_last, strategy in runs:
+        run_dir = os.path.join(img_dir, f"pages_{run_first}")
+        run_texts, run_tables = partition_window(file_path, run_dir, run_first, run_last, strategy)
+        texts += run_texts
+        tables += run_tables
+        # Image names restart at each run, prefix them before moving them next to the other images
+        if os.path.isdir(run_dir):
+            for img_name in os.listdir(run_dir):
+                shutil.move(os.path.join(run_dir, img_name), os.path.join(img_dir, f"{run_first}_{img_name}"))
+            shutil.rmtree(run_dir)
+    return texts, tables, report
+
+def page_count(file_path):
+    with fitz.open(file_path) as doc:
+        return doc.page_count
+
+def partition_stream(file_path, img_dir, start_page, window, workers=1):
+    # Yield (first, last, pages, (texts, tables, strategies)) for consecutive page windows in page order
+    # At most `workers` windows are partitioned ahead of the consumer so memory stays bounded
+    pages = page_count(file_path)
+    windows = [(first, min(first + window, pages)) for first in range(start_page, pages, window)]
+    with partition_executor(max(1, workers)) as pool:
+        in_flight = deque()
+        for first, last in windows:
+            in_flight.append((first, last, pool.submit(partition_pages, file_path, os.path.join(img_dir, str(first)), first, last)))
+            if len(in_flight) >= max(1, workers):
+                first, last, future = in_flight.popleft()
+                yield first, last, pages, future.result()
+        while in_flight:
+            first, last, future = in_flight.popleft()
+            yield first, last, pages, future.result()
+
+def read_ingest_state(store_path):
+    state_path = os.path.join(store_path, ".ingest_state.json")
+    if not os.path.exists(state_path):
+        return None
+    with open(state_path, "r") as file:
+        return json.load(file)
+
+def write_ingest_state(store_path, state):
+    check_path(store_path)
+    with open(os.path.join(store_path, ".ingest_state.json"), "w") as file:
+        json.dump(state, file)
+
+def stream_file(retriever, collection, summarise, embeddings, cache, file_path, IMG_DIR, IMG_DIR_D, store_path, window, workers,
+                id_key, file_name, embed_type, usage, filename, mode, report):
+    # Partition, summarise and index the document one page window at a time, the saved state lets an interrupted ingestion resume
+    # Windows are stored under ids derived from their first page, so a window stored before a crash and indexed again
+    # on resume replaces itself. The task ingesting the file retrieves once the whole file is indexed, the windows
+    # indexed so far only serve other tasks querying the file meanwhile
+    check_path(store_path)
+    with open(os.path.join(store_path, ".ingest.lock"), "w") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Another task is ingesting this document, retrieval runs against what it has indexed so far
+            report("being ingested by another task")
+            return
+        state = read_ingest_state(store_path) or {"next_page": 0, "window": window, "complete": False}
+        if state["complete"]:
+            return
+        for first, last, pages, (texts, tables, strategies) in partition_stream(file_path, IMG_DIR, state["next_page"], state["window"], workers):
+            index_file(retriever, collection, summarise, embeddings, cache, texts, tables,
+                       os.path.join(IMG_DIR, str(first)), os.path.join(IMG_DIR_D, str(first)),
+                       id_key, file_name, embed_type, usage, filename, mode, batch=f"pages_{first}")
+            state.update(next_page=last, pages=pages, complete=last >= pages)
+            write_ingest_state(store_path, state)
+            report(f"indexed pages {first + 1}-{last} of {pages} ({describe_strategies(strategies)})")
+        if not state["complete"]: # no windows left to index
+            state["complete"] = True
+            write_ingest_state(store_path, state)
+
+def describe_strategies(strategies):
+    return ", ".join(f"{count} {strategy} pages" for strategy, count in sorted(strategies.items()))
+
+def report_progress(progress, filename, stage, completed, total):
+    print(f"[{completed}/{total}] {filename}: {stage}")
+    if progress:
+        progress({"file": filename, "stage": stage, "completed": completed, "total": total})
+
+def summarise_chunks(summary_cache, summary_key, summary_chain, embeddings, chunks):
+    # Return the summaries and summary embeddings of raw chunks, only chunks missing from the summary cache go to the LLM
+    keys = [summary_key(chunk) for chunk in chunks]
+    summaries = summary_cache.get_many(keys) if summary_cache else {}
+    missing = [i for i, key in enumerate(keys) if key not in summaries]
+    if missing:
+        results = dict(zip([keys[i] for i in missing], summary_chain.batch([chunks[i] for i in missing], {"max_concurrency": 20})))
+        if summary_cache:
+            summary_cache.put_many(results)
+        summaries.update(results)
+    summaries = [summaries[key] for key in keys]
+    return summaries, embeddings.embed_documents(summaries) if summaries else []
+
+def caption_images(cache, embeddings, IMG_DIR, IMG_DIR_D):
+    # Return the descriptions and description embeddings of the extracted images, keyed by image content
+    # Near-duplicate images are captioned and indexed once, the uncached ones are captioned in one batch
+    check_path(IMG_DIR)
+    check_path(IMG_DIR_D)
+    img_names = [names[0] for names in filter_images(IMG_DIR)]
+    keys = [file_digest(os.path.join(IMG_DIR, img_name)) for img_name in img_names]
+    results = [cache.get_image(key) if cache else None for key in keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        descriptions = image_responses(IMG_DIR, [img_names[i] for i in missing])
+        vectors = embeddings.embed_documents(descriptions)
+        for i, description, vector in zip(missing, descriptions, vectors):
+            results[i] = (description, vector)
+        if cache:
+            cache.put_images([(keys[i], *results[i]) for i in missing])
+    for img_name, (description, _) in zip(img_names, results):
+        # Write the description to a text file next to the image
+        with open(os.path.join(IMG_DIR_D, f"{img_name}.txt"), 'w') as text_file:
+            text_file.write(description)
+    return [r[0] for r in results], [r[1] for r in results]
+
+def store_entries(retriever, collection, entries, vectors, id_key, file_name, embed_type, usage, filename, mode, batch=None):
+    # entries are [embed_type, raw content, summary], the summaries are indexed with their precomputed embeddings
+    # and the raw content goes to the parent document store
+    # With a batch name the ids are derived from it, so storing the same batch again replaces it instead of duplicating it
+    for kind in ["text", "table", "image"]:
+        group = [(entry, vector) for entry, vector in zip(entries, vectors) if entry[0] == kind]
+        if not group:
+            continue
+        if batch is None:
+            doc_ids = [str(uuid.uuid4()) for _ in group]
+            summary_ids = [str(uuid.uuid4()) for _ in group]
+        else:
+            doc_ids = [str(uuid.uuid5(uuid.NAMESPACE_URL, f"{mode}/{filename}/{batch}/{kind}/{i}")) for i in range(len(group))]
+            summary_ids = [str(uuid.uuid5(uuid.NAMESPACE_URL, f"{doc_id}/summary")) for doc_id in doc_ids]
+        summaries = [
+            Document(page_content=entry[2], metadata={id_key: doc_ids[i], file_name: filename, embed_type: kind, usage: mode})
+            for i, (entry, _) in enumerate(group)
+        ]
+        raws = [Document(page_content=entry[1], metadata={id_key: doc_ids, file_name: filename, embed_type: kind, usage: mode}) for entry, _ in group]
+        texts = [doc.page_content for doc in summaries]
+        embeddings = retriever.vectorstore.embeddings
+        if isinstance(embeddings, CachedEmbeddings):
+            # add_texts embeds the summaries again, hand it the precomputed vectors through the embedding cache
+            embeddings.remember(texts, [vector for _, vector in group])
+        retriever.vectorstore.add_texts(texts, metadatas=[doc.metadata for doc in summaries], ids=summary_ids)
+        retriever.docstore.mset(list(zip(doc_ids, raws)))
+    lexical_index.invalidate(collection)
+
+def index_file(retriever, collection, summarise, embeddings, cache, texts, tables, IMG_DIR, IMG_DIR_D, id_key, file_name, embed_type, usage, filename, mode, batch=None):
+    print(len(tables))
+    print(len(texts))
+    # Apply to text
+    text_summary, text_vectors = summarise(texts)
+    # Apply to tables
+    table_summary, table_vectors = summarise(tables)
+    # Describe each image in the directory
+    img_summary, img_vectors = caption_images(cache, embeddings, IMG_DIR, IMG_DIR_D)
+
+    # Add raw texts, tables, image descriptions and their summaries
+    entries = [["text", t, s] for t, s in zip(texts, text_summary)] + \
+              [["table", t, s] for t, s in zip(tables, table_summary)] + \
+              [["image", s, s] for s in img_summary]
+    vectors = text_vectors + table_vectors + img_vectors
+    store_entries(retriever, collection, entries, vectors, id_key, file_name, embed_type, usage, filename, mode, batch)
+
+    for directory_path in [IMG_DIR, IMG_DIR_D]:
+        if os.path.exists(directory_path) and os.path.isdir(directory_path):
+            shutil.rmtree(directory_path)
+            print(f"Removed directory: {directory_path}")
+        else:
+            print(f"Directory does not exist: {directory_path}")
+    return entries, vectors
+
+def partition_process(UP_DIR, user_id, project_id, filenames, IMG_DIR_C, IMG_DIR_CD, model, embeddings, filter, id_key, file_name, embed_type, usage, mode, workers=1, progress=None, cache=None, page_window=None, summary_cache=None, vectorstores=None, file_quota=2):
         BASE_DIR = os.path.dirname(os.path.abspath(__file__))
         # initial prompt for summarization
         prompt_int = """You are an assistant tasked with summarizing tables and text. \
         Give a concise summary of the table or text. Table or text chunk: {element} """
         prompt = ChatPromptTemplate.from_template(prompt_int)
 
-        vectorstore = Chroma(collection_name=f"summary_{user_id}", embedding_function=embeddings, persist_directory=BASE_DIR + "/vectorDB/")
-        print('TEST', filenames)
-        if mode == "chat":
-            doc_filter = {'file_name': filenames[0]}
-        elif mode != "chat" and len(filenames) == 1:
-            doc_filter = {'file_name': filenames[0] + '.pdf'}
+        collection = VectorStorePool.collection_name(user_id)
+        if vectorstores is not None:
+            vectorstore = vectorstores.get(user_id)
         else:
-            doc_filter = {"$or": [{'file_name': f + '.pdf'} for f in filenames]}  
+            vectorstore = Chroma(collection_name=collection, embedding_function=embeddings, persist_directory=BASE_DIR + "/vectorDB/")
+        print('TEST', filenames)
 
+        retrievers = {} # retriever of each file, keyed by the stored file name
+        store_paths = {} # parent document store directory of each file
+        jobs = [] # files with no existing embeddings, to be partitioned
+        streams = [] # files to be partitioned in page windows
         for filename in filenames:
             if mode == "chat":
                 existing_documents = vectorstore.get(where={"usage": "chat"})['ids']
-                fs = LocalFileStore(BASE_DIR + "/vectorDB/" + "parentData/" + user_id + '/chat/' + filename)
+                store_path = BASE_DIR + "/vectorDB/" + "parentData/" + user_id + '/chat/' + filename
                 # The storage layer for the parent documents
-                store = create_kv_docstore(fs)
+                store = open_docstore(store_path)
          
                 retriever = MultiVectorRetriever(
                     vectorstore=vectorstore,
@@ -163,9 +534,9 @@ def partition_process(UP_DIR, user_id, project_id, filenames, IMG_DIR_C, IMG_DIR
                         {"usage": f"project_{project_id}"}
                     ]
                     })['ids']
-                fs = LocalFileStore(BASE_DIR + "/vectorDB/" + "/parentData/" + '/' + user_id + '/' + project_id + '/' + filename)
+                store_path = BASE_DIR + "/vectorDB/" + "/parentData/" + '/' + user_id + '/' + project_id + '/' + filename
                 # The storage layer for the parent documents
-                store = create_kv_docstore(fs)
+                store = open_docstore(store_path)
 
                 retriever = MultiVectorRetriever(
                     vectorstore=vectorstore,
@@ -176,129 +547,71 @@ def partition_process(UP_DIR, user_id, project_id, filenames, IMG_DIR_C, IMG_DIR
                     usage=usage,
                     search_kwargs={'k': 20, 'filter': {
                         "$and": [
-                            doc_filter,
+                            {'file_name': filename},
                             {"usage": f"project_{project_id}"}
                         ]
                     }},
                 )
 
-            if len(existing_documents) == 0: # If no existing documents embedding are found, start indexing
-                # Get PDF elements
-                pdf_elements = partition_pdf(
-                filename=os.path.join(UP_DIR, filename), 
-                # Using pdf format to find embedded image blocks
-                extract_images_in_pdf=True,
-                # Use layout model (YOLOX) to get bounding boxes (for tables) and find titles
-                # Titles are any sub-section of the document
-                infer_table_structure=True,
-                # Post processing to aggregate text once we have the title
-                chunking_strategy="by_title",
-                # Chunking params to aggregate text blocks
-                # Attempt to create a new chunk 3800 chars
-                # Attempt to keep chunks > 2000 chars
-                # Hard max on chunks
-                max_characters=4000,
-                new_after_n_chars=3800,
-                combine_text_under_n_chars=2000,
-                overlap=200,
-                extract_image_block_output_dir=IMG_DIR_C
-                )
-                # Create a dictionary to store counts of each type
-                category_counts = {}
-                for element in pdf_elements:
-                    category = str(type(element))
-                    if category in category_counts:
-                        category_counts[category] += 1
-                    else:
-                        category_counts[category] = 1
-
-                # Unique_categories will have unique elements
-                unique_categories = set(category_counts.keys())
-                category_counts
-                # Categorize by type
-                categorized_elements = []
-                for element in pdf_elements:
-                    if "unstructured.documents.elements.Table" in str(type(element)):
-                        categorized_elements.append(Element(type="table", text=str(element)))
-                    elif "unstructured.documents.elements.CompositeElement" in str(type(element)):
-                        categorized_elements.append(Element(type="text", text=str(element)))
-
-                # Tables
-                table_elements = [e for e in categorized_elements if e.type == "table"]
-                print(len(table_elements))
-                # Text
-                text_elements = [e for e in categorized_elements if e.type == "text"]
-                print(len(text_elements))
-                # chain for summarisation of text and tables
-                summary_chain = {"element": lambda x: x} | prompt | model | StrOutputParser()
-
-                # Apply to text
-                texts = [i.text for i in text_elements]
-                text_summary = summary_chain.batch(texts, {"max_concurrency": 20})
-                # Apply to tables
-                tables = [i.text for i in table_elements]
-                table_summary = summary_chain.batch(tables, {"max_concurrency": 20})
-
-                # Loop through each image in the directory
-                img_summary = []
-                img_name = ""
-                for img_name in os.listdir(IMG_DIR_C):
-
-                    description = image_response(IMG_DIR_C, img_name)
-                    # Path to the text file to save the description
-                    text_file_path = os.path.join(IMG_DIR_CD, f"{img_name}.txt")
-                    check_path(IMG_DIR_CD)
-                    # Write the description to the text file
-                    with open(text_file_path, 'w') as text_file:
-                        text_file.write(description)
-
-                # Get all .txt file summaries
-                file_paths = glob.glob(os.path.expanduser(os.path.join(IMG_DIR_CD, "*.txt")))
-
-                # Read each file and store its content in a list
-                for file_path in file_paths:
-                    with open(file_path, "r") as file:
-                        img_summary.append(file.read())
-                
-                # Add raw texts and summaries
-                if texts:
-                    doc_ids = [str(uuid.uuid4()) for _ in texts]
-                    summary_texts = [
-                        Document(page_content=s, metadata={id_key: doc_ids[i], file_name: filename, embed_type: "text", usage: mode})
-                        for i, s in enumerate(text_summary)
-                    ]
-                    texts = [Document(page_content=t, metadata={id_key: doc_ids, file_name: filename, embed_type: "text", usage: mode}) for t in texts]
-                    retriever.vectorstore.add_documents(summary_texts)
-                    retriever.docstore.mset(list(zip(doc_ids, texts)))
-
-                # Add raw tables and summaries
-                if tables:
-                    table_ids = [str(uuid.uuid4()) for _ in tables]
-                    summary_tables = [
-                        Document(page_content=s, metadata={id_key: table_ids[i], file_name: filename, embed_type: "table", usage: mode})
-                        for i, s in enumerate(table_summary)
-                    ]
-                    tables = [Document(page_content=t, metadata={id_key: table_ids, file_name: filename, embed_type: "table", usage: mode}) for t in tables]
-                    retriever.vectorstore.add_documents(summary_tables)
-                    retriever.docstore.mset(list(zip(table_ids, tables)))
-
-                # Add image summaries
-                if img_summary:
-                    img_ids = [str(uuid.uuid4()) for _ in img_summary]
-                    summary_img = [
-                        Document(page_content=s, metadata={id_key: img_ids[i], file_name: filename, embed_type: "image", usage: mode})
-                        for i, s in enumerate(img_summary)
-                    ]
-                    img_summary = [Document(page_content=i, metadata={id_key: img_ids, file_name: filename, embed_type: "image", usage: mode}) for i in img_summary]
-                    retriever.vectorstore.add_documents(summary_img)
-                    retriever.docstore.mset(list(zip(img_ids, img_summary)))
-
-                for directory_path in [IMG_DIR_C, IMG_DIR_CD]:
-                    if os.path.exists(directory_path) and os.path.isdir(directory_path):
-                        shutil.rmtree(directory_path)
-                        print(f"Removed directory: {directory_path}")
-                    else:
-                        print(f"Directory does not exist: {directory_path}")
+            retrievers[filename] = retriever
+            store_paths[filename] = store_path
+            state = read_ingest_state(store_path)
+            if state and not state["complete"]: # A streamed ingestion was interrupted, resume from its last indexed window
+                streams.append((filename, os.path.join(UP_DIR, filename), os.path.join(IMG_DIR_C, filename)))
+            elif len(existing_documents) == 0: # If no existing documents embedding are found, start indexing
+                # each file extracts its images into its own folder so files can be partitioned side by side
+                jobs.append((filename, os.path.join(UP_DIR, filename), os.path.join(IMG_DIR_C, filename)))
+
+        # chain for summarisation of text and tables
+        summary_chain = {"element": lambda x: x} | prompt | model | StrOutputParser()
+        summary_key = lambda chunk: SummaryCache.key(chunk, prompt_int, getattr(model, 'model', ''), getattr(model, 'temperature', ''))
+        summarise = lambda chunks: summarise_chunks(summary_cache, summary_key, summary_chain, embeddings, chunks)
+        # summaries and embeddings are only reusable with the same prompt and models
+        fingerprint = text_digest(f"{prompt_int}|{getattr(model, 'model', '')}|{getattr(model, 'temperature', '')}|{getattr(embeddings, 'model', '')}")
+
+        total = len(jobs) + len(streams)
+        completed = 0
+        keys = {}
+        pending = []
+        for job in jobs:
+            filename = job[0]
+            keys[filename] = text_digest(file_digest(job[1]) + fingerprint)
+            cached = cache.get_file(keys[filename]) if cache else None
+            if cached: # A byte-identical file was already ingested, link its output into this usage scope
+                store_entries(retrievers[filename], collection, *cached, id_key, file_name, embed_type, usage, filename, mode)
+                completed += 1
+                report_progress(progress, filename, "linked from cache", completed, total)
+            elif page_window and page_count(job[1]) > page_window:
+                # Large documents are streamed in page windows to bound memory, only their chunks and images are cached
+                streams.append(job)
+            else:
+                pending.append(job)
+                report_progress(progress, filename, "partitioning", completed, total)
+
+        # Partition the files in a bounded worker pool, summarise and index each one as soon as it is partitioned
+        for filename, (texts, tables, strategies) in partition_files(pending, workers):
+            report_progress(progress, filename, f"summarising ({describe_strategies(strategies)})", completed, total)
+            entries, vectors = index_file(retrievers[filename], collection, summarise, embeddings, cache, texts, tables,
+                                          os.path.join(IMG_DIR_C, filename), os.path.join(IMG_DIR_CD, filename),
+                                          id_key, file_name, embed_type, usage, filename, mode)
+            if cache:
+                cache.put_file(keys[filename], entries, vectors)
+            completed += 1
+            report_progress(progress, filename, "indexed", completed, total)
+
+        for filename, file_path, img_dir in streams:
+            stream_file(retrievers[filename], collection, summarise, embeddings, cache, file_path, img_dir, os.path.join(IMG_DIR_CD, filename),
+                        store_paths[filename], page_window or 25, workers, id_key, file_name, embed_type, usage, filename, mode,
+                        lambda stage: report_progress(progress, filename, stage, completed, total))
+            completed += 1
+            report_progress(progress, filename, "indexed", completed, total)
+
+        for directory_path in [IMG_DIR_C, IMG_DIR_CD]:
+            if os.path.exists(directory_path) and os.path.isdir(directory_path):
+                shutil.rmtree(directory_path)
+        if len(retrievers) > 1:
+            # each file is searched with its own filter and parent store, see MultiFileRetriever
+            return MultiFileRetriever(retrievers, collection, k=20, quota=file_quota)
         return retriever
 
 
@@ -383,6 +696,101 @@ class DPIAPDFGenerator:
 def split_text_into_chunks(text, chunk_size=6500):
     return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
 
+# cl100k token counts scaled to the tokenizer of each Ollama model, the factors err on the high side
+TOKEN_FACTORS = {"gemma2": 1.15, "phi3": 1.1, "qwen2": 1.05}
+# tokens of the system prompt and task framing CrewAI wraps around every task description
+CREW_OVERHEAD = 400
+
+class TokenCounter:
+    def __init__(self, model):
+        self.encoding = tiktoken.get_encoding("cl100k_base")
+        self.factor = TOKEN_FACTORS.get(model.split(":")[0], 1.2)
+
+    def count(self, text):
+        return math.ceil(len(self.encoding.encode(text, disallowed_special=())) * self.factor)
+
+@lru_cache(maxsize=None)
+def token_counter(model):
+    return TokenCounter(model)
+
+def prompt_tokens(counter, describe, agent):
+    # Tokens of one call without its context: the task description, the agent persona and the CrewAI framing
+    return counter.count(describe('', '') + agent.role + agent.goal + agent.backstory) + CREW_OVERHEAD
+
+def pack_context(passages, counter, reserved, num_ctx=8000, answer_tokens=1024, min_budget=1024):
+    # Pack whole passages, in rank order, into as few windows as fit the context of the model
+    # Each window leaves room for the reserved prompt tokens, the previous answer of the refine chain and the new answer
+    # A passage is never split, one larger than the budget gets a window of its own
+    # A prompt leaving less than min_budget tokens still packs windows of min_budget tokens, Ollama truncates the overflow
+    # Return the windows and the number of LLM calls saved over fixed 6500 character chunks, never below zero
+    budget = num_ctx - reserved - 2 * answer_tokens
+    if budget < min_budget:
+        print(f"Prompt of {reserved} tokens leaves a window budget of {budget} tokens, packing {min_budget} tokens per window")
+        budget = min_budget
+    windows = []
+    current = []
+    used = 0
+    for passage in passages:
+        tokens = counter.count(passage)
+        if current and used + tokens > budget:
+            windows.append("\n\n".join(current))
+            current, used = [], 0
+        if tokens > budget:
+            print(f"Passage of {tokens} tokens exceeds the window budget of {budget} tokens")
+        current.append(passage)
+        used += tokens
+    if current:
+        windows.append("\n\n".join(current))
+    # packing whole passages can take more windows than fixed chunks when the passages are large
+    saved = max(0, len(split_text_into_chunks(''.join(passages))) - len(windows))
+    return windows, saved
+
+def answer_chunk(agent, description, expected_output):
+    task = Task(description=description, expected_output=expected_output, agent=agent)
+    crew = Crew(
+        agents=[agent],
+        tasks=[task],
+        processes=Process.sequential
+    )
+    return crew.kickoff().raw
+
+def refine_response(split_content, describe, expected_output, agent):
+    # Refine chain: each chunk is answered with the answer of the previous chunks as context, one call after another
+    sequential_answer = ''
+    for content in split_content:
+        sequential_answer = answer_chunk(agent, describe(sequential_answer, content), expected_output)
+    return sequential_answer
+
+def reduce_description(partials, prompt):
+    return (f"""Each partial answer below was written from a different part of the context.\n {partials}\n
+                    Merge the partial answers into a single answer to the prompt: {prompt}.
+                    Keep every relevant detail once, drop repetitions and resolve contradictions.""")
+
+def map_reduce_response(split_content, describe, expected_output, prompt, agent, workers=2):
+    # Map: every chunk is answered on its own and concurrently, each call with its own copy of the agent
+    # Reduce: the partial answers are packed into as few calls as fit the context of the model and merged,
+    # in further steps if more than one call was needed, until a single answer is left
+    if len(split_content) <= 1:
+        return refine_response(split_content, describe, expected_output, agent)
+    counter = token_counter(agent.llm.model)
+    reserved = prompt_tokens(counter, lambda previous, content: reduce_description(content, prompt), agent)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        answers = list(pool.map(lambda content: answer_chunk(agent.copy(), describe('', content), expected_output), split_content))
+        while len(answers) > 1:
+            partials = [f"Partial answer {i + 1}: {answer}" for i, answer in enumerate(answers)]
+            windows, _ = pack_context(partials, counter, reserved)
+            if len(windows) == len(partials): # every partial answer fills a call on its own, merge them in pairs
+                windows = ["\n\n".join(partials[i:i + 2]) for i in range(0, len(partials), 2)]
+            answers = list(pool.map(lambda window: answer_chunk(agent.copy(), reduce_description(window, prompt), expected_output), windows))
+    return answers[0]
+
+def synthesise_response(mode, split_content, describe, expected_output, prompt, agent, workers=2):
+    # mode is "refine" (default) or "map_reduce"
+    # describe(previous answer, chunk) returns the task description of one chunk
+    if mode == "map_reduce":
+        return map_reduce_response(split_content, describe, expected_output, prompt, agent, workers)
+    return refine_response(split_content, describe, expected_output, agent)
+
 def expanded_response(initial_answer, rerank_content, prompt, first_agent, second_agent):
     expand_answer = Task(
         description= (f"""Based on the provided context: {initial_answer}\n {rerank_content}\n 
@@ -0,0 +1,182 @@
+import os, re, json, math, uuid, tempfile, threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.documents import Document
+from cache import text_digest
+
+TOKEN = re.compile(r"\w+")
+STOPWORDS = frozenset("""a an and are as at be by for from has have in is it its of on or that the this to was were will with
+which what who how do does should must can may any all their they them your you our we""".split())
+
+
+def tokenize(text):
+    return [token for token in TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+
+class BM25:
+    # Okapi BM25 over a fixed list of documents, an inverted index so a query only touches documents sharing a term
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}
+        self.lengths = []
+        for i, document in enumerate(documents):
+            terms = Counter(tokenize(document))
+            self.lengths.append(sum(terms.values()))
+            for term, frequency in terms.items():
+                self.postings.setdefault(term, []).append((i, frequency))
+        self.average = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+
+    def search(self, query, k=20):
+        # Return [(document index, score)] of the k best matching documents, best first
+        scores = {}
+        count = len(self.lengths)
+        for term in set(tokenize(query)):
+            postings = self.postings.get(term, [])
+            if not postings:
+                continue
+            idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for i, frequency in postings:
+                norm = frequency + self.k1 * (1 - self.b + self.b * self.lengths[i] / self.average)
+                scores[i] = scores.get(i, 0.0) + idf * frequency * (self.k1 + 1) / norm
+        return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+
+
+class LexicalIndex:
+    # BM25 indexes of the child documents (summaries, or chunks of the knowledge base) of a Chroma collection,
+    # one per metadata filter, kept in memory and rebuilt when the collection has been written to since
+    # Every write to a collection calls invalidate(), which replaces the collection's version file, a file
+    # so writes by the Flask process and other workers are seen too, at the cost of one small read per query
+    # Collections are named by the caller, the name the collection was opened with, e.g. summary_<user> or chatData
+    def __init__(self, version_dir, max_indexes=32):
+        self.version_dir = version_dir
+        self.max_indexes = max_indexes
+        self.indexes = OrderedDict()
+        self.lock = threading.Lock()
+
+    def version(self, name):
+        try:
+            with open(os.path.join(self.version_dir, name), "r") as file:
+                return file.read()
+        except FileNotFoundError:
+            return ""
+
+    def invalidate(self, name):
+        os.makedirs(self.version_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=self.version_dir)
+        with os.fdopen(fd, "w") as file:
+            file.write(uuid.uuid4().hex)
+        os.replace(path, os.path.join(self.version_dir, name))
+
+    def get(self, name, vectorstore, where=None):
+        # Return (BM25, ids, metadatas) of the documents of the collection `name` matching the filter
+        where = where or None
+        key = (name, json.dumps(where, sort_keys=True))
+        # read before the documents, a write landing while the index is built leaves it stale and rebuilt next time
+        version = self.version(name)
+        with self.lock:
+            cached = self.indexes.get(key)
+            if cached is not None and cached[0] == version:
+                self.indexes.move_to_end(key)
+                return cached[1]
+        found = vectorstore.get(where=where, include=["documents", "metadatas"])
+        index = (BM25(found['documents']), found['ids'], found['metadatas'])
+        with self.lock:
+            self.indexes[key] = (version, index)
+            self.indexes.move_to_end(key)
+            while len(self.indexes) > self.max_indexes:
+                self.indexes.popitem(last=False)
+        return index
+
+
+lexical_index = LexicalIndex(os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "collections"))
+
+def fuse(rankings, k=60):
+    # Reciprocal rank fusion of several rankings of ids, return {id: score}, ids ranked high by any of them score highest
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank + 1)
+    return scores
+
+def parent_ranking(retriever, hits):
+    # Parent ids of the child hits in order, a parent is ranked by its best child
+    ranking = []
+    for metadata in hits:
+        parent = (metadata or {}).get(retriever.id_key)
+        if parent is not None and parent not in ranking:
+            ranking.append(parent)
+    return ranking
+
+def vector_scores(retriever, query, k=20):
+    # Return {parent id: score} from the similarity search of the children, higher is better
+    scores = {}
+    for doc, distance in retriever.vectorstore.similarity_search_with_score(query, k=k, filter=retriever.search_kwargs.get('filter') or None):
+        parent = doc.metadata.get(retriever.id_key)
+        if parent is not None and parent not in scores:
+            scores[parent] = -distance
+    return scores
+
+def hybrid_scores(retriever, collection, query, k=20):
+    # Return {parent id: fused score} from the vector and BM25 searches of the children, higher is better
+    # collection is the name of the retriever's vector store collection, which keys its BM25 index
+    where = retriever.search_kwargs.get('filter') or None
+    vector_hits = retriever.vectorstore.similarity_search(query, k=k, filter=where)
+    bm25, ids, metadatas = lexical_index.get(collection, retriever.vectorstore, where)
+    lexical_hits = [metadatas[i] for i, _ in bm25.search(query, k)]
+    return fuse([parent_ranking(retriever, [doc.metadata for doc in vector_hits]), parent_ranking(retriever, lexical_hits)])
+
+def hybrid_search(retriever, collection, query, candidates=8, k=20):
+    # Fused vector and BM25 search over the children of a MultiVectorRetriever or ParentDocumentRetriever,
+    # returning the parent documents of the best candidates, best first
+    scores = hybrid_scores(retriever, collection, query, k)
+    parent_ids = sorted(scores, key=lambda key: scores[key], reverse=True)[:candidates]
+    docs = retriever.docstore.mget(parent_ids)
+    return [doc for doc in docs if isinstance(doc, Document)]
+
+
+class MultiFileRetriever:
+    # Retrieval over several files, each queried on its own and in parallel so a verbose file cannot crowd out the rest
+    # Every file keeps its best `quota` parents, the remaining slots go to the best parents of any file
+    def __init__(self, retrievers, collection, k=20, quota=2, workers=4):
+        self.retrievers = retrievers # {file name: retriever filtered to that file}
+        self.collection = collection # name of the vector store collection the retrievers share
+        self.k = k
+        self.quota = quota
+        self.workers = workers
+
+    def invoke(self, query, mode="vector", limit=None):
+        limit = limit or self.k
+        if mode == "hybrid":
+            score = lambda retriever: hybrid_scores(retriever, self.collection, query, self.k)
+        else:
+            score = lambda retriever: vector_scores(retriever, query, self.k)
+        names = list(self.retrievers)
+        with ThreadPoolExecutor(max_workers=max(min(self.workers, len(names)), 1)) as pool:
+            scored = dict(zip(names, pool.map(lambda name: score(self.retrievers[name]), names)))
+
+        ranked = {name: sorted(scores.items(), key=lambda item: item[1], reverse=True) for name, scores in scored.items()}
+        selected = [(value, name, parent) for name, items in ranked.items() for parent, value in items[:self.quota]]
+        rest = sorted(((value, name, parent) for name, items in ranked.items() for parent, value in items[self.quota:]), reverse=True)
+        selected = sorted(selected + rest[:max(limit - len(selected), 0)], reverse=True)
+
+        # Fetch the parents from the store of their file, dropping identical documents found in several files
+        parents = {name: [parent for _, file, parent in selected if file == name] for name in names}
+        found = {name: dict(zip(ids, self.retrievers[name].docstore.mget(ids))) for name, ids in parents.items() if ids}
+        docs, seen = [], set()
+        for _, name, parent in selected:
+            doc = found[name].get(parent)
+            if isinstance(doc, Document) and text_digest(doc.page_content) not in seen:
+                seen.add(text_digest(doc.page_content))
+                docs.append(doc)
+        return docs
+
+
+def retrieve(retriever, collection, query, mode="vector", candidates=8):
+    # mode is "vector", the retriever's own similarity search, or "hybrid" for fused vector and BM25 search
+    # collection is the name of the collection searched, a MultiFileRetriever carries its own
+    if isinstance(retriever, MultiFileRetriever):
+        return retriever.invoke(query, mode, candidates if mode == "hybrid" else None)
+    if mode == "hybrid":
+        return hybrid_search(retriever, collection, query, candidates)
+    return retriever.invoke(query)
@@ -78,4 +78,16 @@ class DPIA_File(db.Model):
     fileID = db.Column(db.Integer, db.ForeignKey('file.fileID'), nullable=False)
 
     def __repr__(self):
-        return f'<Dpia_File {self.dpiaID} {self.fileID}>'
\ No newline at end of file
+        return f'<Dpia_File {self.dpiaID} {self.fileID}>'
+
+class DPIA_Section(db.Model):
+    __tablename__ = 'dpia_section'
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    dpiaID = db.Column(db.Integer, db.ForeignKey('dpia.dpiaID'), nullable=False)
+    step = db.Column(db.String, nullable=False)
+    section = db.Column(db.String, nullable=False)
+    prompt = db.Column(db.String, nullable=False)
+    content = db.Column(db.String, nullable=False)
+
+    def __repr__(self):
+        return f'<Dpia_Section {self.dpiaID} {self.section}>'
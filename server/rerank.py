@@ -1,23 +1,134 @@
-import os
+import os, fcntl, tempfile, threading
+import numpy as np
 from huggingface_hub import snapshot_download
 from sentence_transformers import CrossEncoder
 
 
-def rerank_response(query, documents):
-    HUGGINGFACE_KEY = os.environ.get("HUGGINGFACE_KEY")
+class Reranker:
+    # Keeps the CrossEncoder resident in the worker process, it is loaded on first use and shared by all tasks
+    def __init__(self, model_id="mixedbread-ai/mxbai-rerank-base-v1", batch_size=32):
+        self.model_id = model_id
+        self.batch_size = batch_size
+        self.model = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        with self.lock:
+            if self.model is None:
+                HUGGINGFACE_KEY = os.environ.get("HUGGINGFACE_KEY")
+                snapshot_download(repo_id=self.model_id, token=HUGGINGFACE_KEY)
+                # Load the model, here we use our base sized model
+                self.model = CrossEncoder(self.model_id)
+        return self.model
+
+    def predict(self, pairs):
+        return self.load().predict(pairs, batch_size=self.batch_size, show_progress_bar=False)
+
+    def rank_batch(self, groups, top_k=10):
+        # Score every (query, document) pair of all groups in one padded pass over the model
+        # and return the top_k documents of each group, best first
+        pairs = [(query, document) for query, documents in groups for document in documents]
+        if not pairs:
+            return [[] for _ in groups]
+        scores = self.predict(pairs)
+        results = []
+        start = 0
+        for _, documents in groups:
+            group_scores = scores[start:start + len(documents)]
+            start += len(documents)
+            ranked = sorted(range(len(documents)), key=lambda i: group_scores[i], reverse=True)[:top_k]
+            results.append([documents[i] for i in ranked])
+        return results
+
+    def rank(self, query, documents, top_k=10):
+        return self.rank_batch([(query, documents)], top_k)[0]
+
 
-    model_id = "mixedbread-ai/mxbai-rerank-base-v1"
-    snapshot_download(repo_id=model_id, token=HUGGINGFACE_KEY)
+class OnnxReranker(Reranker):
+    # Same model exported to ONNX and dynamically quantized to int8, for inference boxes without a GPU
+    # The export runs once and is kept next to the Hugging Face snapshot
+    def __init__(self, model_id="mixedbread-ai/mxbai-rerank-base-v1", batch_size=32, max_length=512):
+        super().__init__(model_id, batch_size)
+        self.max_length = max_length
+        self.tokenizer = None
 
-    # Load the model, here we use our base sized model
-    model = CrossEncoder("mixedbread-ai/mxbai-rerank-base-v1")
-    # Lets get the scores
-    results = model.rank(query, documents, return_documents=True, top_k=10)
-    format_results = [entry['text'] for entry in results]
+    def export(self, model_dir):
+        import torch
+        from transformers import AutoModelForSequenceClassification, AutoTokenizer
+        from onnxruntime.quantization import quantize_dynamic, QuantType
 
-    del model
+        onnx_dir = os.path.join(model_dir, "onnx")
+        int8_path = os.path.join(onnx_dir, "model.int8.onnx")
+        if os.path.exists(int8_path):
+            return int8_path
+        os.makedirs(onnx_dir, exist_ok=True)
+        with open(os.path.join(onnx_dir, ".export.lock"), "w") as lock:
+            # every worker process loads the reranker, only the first one to take the lock exports, the others wait for it
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(int8_path):
+                return int8_path
+            # both models are written under temporary names and renamed once complete, so no reader sees a partial file
+            onnx_tmp = tempfile.mkstemp(suffix=".onnx", dir=onnx_dir)
+            int8_tmp = tempfile.mkstemp(suffix=".onnx", dir=onnx_dir)
+            for fd, _ in (onnx_tmp, int8_tmp):
+                os.close(fd)
+            try:
+                model = AutoModelForSequenceClassification.from_pretrained(model_dir).eval()
+                tokenizer = AutoTokenizer.from_pretrained(model_dir)
+                sample = tokenizer(["query"], ["document"], return_tensors="pt")
+                names = list(sample.keys())
+                torch.onnx.export(
+                    model, tuple(sample[name] for name in names), onnx_tmp[1],
+                    input_names=names, output_names=["logits"],
+                    dynamic_axes={**{name: {0: "batch", 1: "sequence"} for name in names}, "logits": {0: "batch"}},
+                    opset_version=14,
+                )
+                quantize_dynamic(onnx_tmp[1], int8_tmp[1], weight_type=QuantType.QInt8)
+                os.replace(onnx_tmp[1], os.path.join(onnx_dir, "model.onnx"))
+                os.replace(int8_tmp[1], int8_path)
+            finally:
+                for _, path in (onnx_tmp, int8_tmp):
+                    if os.path.exists(path):
+                        os.remove(path)
+        return int8_path
 
-    return format_results
-    
+    def load(self):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
 
+        with self.lock:
+            if self.model is None:
+                HUGGINGFACE_KEY = os.environ.get("HUGGINGFACE_KEY")
+                model_dir = snapshot_download(repo_id=self.model_id, token=HUGGINGFACE_KEY)
+                self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+                self.model = ort.InferenceSession(self.export(model_dir), providers=["CPUExecutionProvider"])
+        return self.model
 
+    def predict(self, pairs):
+        session = self.load()
+        names = {i.name for i in session.get_inputs()}
+        scores = []
+        for start in range(0, len(pairs), self.batch_size):
+            batch = pairs[start:start + self.batch_size]
+            features = self.tokenizer([q for q, _ in batch], [d for _, d in batch], padding=True, truncation=True,
+                                      max_length=self.max_length, return_tensors="np")
+            logits = session.run(["logits"], {name: value.astype(np.int64) for name, value in features.items() if name in names})[0]
+            scores.append(logits[:, 0])
+        # Raw logits rank the same as the sigmoid scores of the CrossEncoder
+        return np.concatenate(scores)
+
+
+reranker = None
+
+def get_reranker():
+    # RERANK_BACKEND selects the backend: "torch" (default) or "onnx" for the int8 CPU model
+    global reranker
+    if reranker is None:
+        reranker = OnnxReranker() if os.environ.get("RERANK_BACKEND", "torch") == "onnx" else Reranker()
+    return reranker
+
+def rerank_responses(groups):
+    return get_reranker().rank_batch(groups)
+
+def rerank_response(query, documents):
+    return get_reranker().rank(query, documents)
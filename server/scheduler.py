@@ -0,0 +1,32 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def section_graph(template):
+    # Return {(step, section): (from step, from section) or None} in template order
+    # Only a reference to an earlier section is a dependency, as when the template is written top to bottom
+    graph = {}
+    for step_key, step_value in template.items():
+        for part_key, part_value in step_value.items():
+            reference = (part_value['from']['Step'], part_value['from']['Section'])
+            graph[(step_key, part_key)] = reference if reference in graph else None
+    return graph
+
+def run_sections(template, write, max_workers=2):
+    # Call write(step, section, previous response) for every section of the template, sections whose
+    # dependency is complete run concurrently, and each dependent section receives its predecessor's output
+    graph = section_graph(template)
+    results = {}
+    pending = dict(graph)
+    running = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            ready = [node for node, dependency in pending.items() if dependency is None or dependency in results]
+            for node in ready:
+                del pending[node]
+                running[pool.submit(write, *node, results.get(graph[node]))] = node
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                results[running.pop(future)] = future.result()
+
+    # Rebuild the steps in template order
+    return {step_key: {part_key: results[(step_key, part_key)] for part_key in step_value} for step_key, step_value in template.items()}
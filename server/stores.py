@@ -0,0 +1,39 @@
+import os, threading
+import chromadb
+from chromadb.config import Settings
+from langchain_chroma import Chroma
+
+
+class VectorStorePool:
+    # Open handles of the per-user summary_<user> collections, shared by all requests and tasks of a process
+    # All handles share one persistent Chroma client, which holds the loaded indexes of every collection, so a
+    # handle is a light wrapper and dropping one frees nothing. Memory is bounded by the client instead, it
+    # unloads the least recently used collection indexes once they take more than memory_limit bytes
+    def __init__(self, persist_directory, embeddings, memory_limit=None):
+        self.persist_directory = persist_directory
+        self.embeddings = embeddings
+        self.memory_limit = memory_limit
+        self.client = None
+        self.handles = {}
+        self.lock = threading.Lock()
+        self.pid = None
+
+    @staticmethod
+    def collection_name(user_id):
+        return f"summary_{user_id}"
+
+    def get(self, user_id):
+        with self.lock:
+            if self.pid != os.getpid():
+                # a forked Celery worker must not reuse the client of its parent
+                settings = Settings(chroma_segment_cache_policy="LRU", chroma_memory_limit_bytes=self.memory_limit) \
+                    if self.memory_limit else Settings()
+                self.client = chromadb.PersistentClient(path=self.persist_directory, settings=settings)
+                self.handles.clear()
+                self.pid = os.getpid()
+            name = self.collection_name(user_id)
+            vectorstore = self.handles.get(name)
+            if vectorstore is None:
+                vectorstore = Chroma(collection_name=name, embedding_function=self.embeddings, client=self.client)
+                self.handles[name] = vectorstore
+            return vectorstore
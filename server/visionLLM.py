@@ -1,4 +1,4 @@
-import os, gc
+import os, gc, time, threading
 from huggingface_hub import snapshot_download
 import torch
 import torchvision.transforms as T
@@ -6,116 +6,189 @@ from PIL import Image
 from torchvision.transforms.functional import InterpolationMode
 from transformers import AutoModel, AutoTokenizer
 
-def image_response(img_path, img_name):
-    HUGGINGFACE_KEY = os.environ.get("HUGGINGFACE_KEY")
-
-    model_id = "OpenGVLab/InternVL2-4B"
-    snapshot_download(repo_id=model_id, token=HUGGINGFACE_KEY)
-
-    IMAGENET_MEAN = (0.485, 0.456, 0.406)
-    IMAGENET_STD = (0.229, 0.224, 0.225)
-
-    def build_transform(input_size):
-        MEAN, STD = IMAGENET_MEAN, IMAGENET_STD
-        transform = T.Compose([
-            T.Lambda(lambda img: img.convert('RGB') if img.mode != 'RGB' else img),
-            T.Resize((input_size, input_size), interpolation=InterpolationMode.BICUBIC),
-            T.ToTensor(),
-            T.Normalize(mean=MEAN, std=STD)
-        ])
-        return transform
-
-    def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
-        best_ratio_diff = float('inf')
-        best_ratio = (1, 1)
-        area = width * height
-        for ratio in target_ratios:
-            target_aspect_ratio = ratio[0] / ratio[1]
-            ratio_diff = abs(aspect_ratio - target_aspect_ratio)
-            if ratio_diff < best_ratio_diff:
-                best_ratio_diff = ratio_diff
-                best_ratio = ratio
-            elif ratio_diff == best_ratio_diff:
-                if area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
-                    best_ratio = ratio
-        return best_ratio
-
-    def dynamic_preprocess(image, min_num=1, max_num=6, image_size=448, use_thumbnail=False):
-        orig_width, orig_height = image.size
-        aspect_ratio = orig_width / orig_height
-
-        # calculate the existing image aspect ratio
-        target_ratios = set(
-            (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
-            i * j <= max_num and i * j >= min_num)
-        target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
-
-        # find the closest aspect ratio to the target
-        target_aspect_ratio = find_closest_aspect_ratio(
-            aspect_ratio, target_ratios, orig_width, orig_height, image_size)
-
-        # calculate the target width and height
-        target_width = image_size * target_aspect_ratio[0]
-        target_height = image_size * target_aspect_ratio[1]
-        blocks = target_aspect_ratio[0] * target_aspect_ratio[1]
-
-        # resize the image
-        resized_img = image.resize((target_width, target_height))
-        processed_images = []
-        for i in range(blocks):
-            box = (
-                (i % (target_width // image_size)) * image_size,
-                (i // (target_width // image_size)) * image_size,
-                ((i % (target_width // image_size)) + 1) * image_size,
-                ((i // (target_width // image_size)) + 1) * image_size
-            )
-            # split the image
-            split_img = resized_img.crop(box)
-            processed_images.append(split_img)
-        assert len(processed_images) == blocks
-        if use_thumbnail and len(processed_images) != 1:
-            thumbnail_img = image.resize((image_size, image_size))
-            processed_images.append(thumbnail_img)
-        return processed_images
-
-
-    def load_image(image_file, input_size=448, max_num=6):
-        image = Image.open(image_file).convert('RGB')
-        transform = build_transform(input_size=input_size)
-        images = dynamic_preprocess(image, image_size=input_size, use_thumbnail=True, max_num=max_num)
-        pixel_values = [transform(image) for image in images]
-        pixel_values = torch.stack(pixel_values)
-        return pixel_values
-
-
-    path = 'OpenGVLab/InternVL2-4B'
-    model = AutoModel.from_pretrained(
-        path,
-        torch_dtype=torch.bfloat16,
-        low_cpu_mem_usage=True,
-        trust_remote_code=True).eval().cuda()
-
-    tokenizer = AutoTokenizer.from_pretrained(path, trust_remote_code=True)
-    # set the max number of tiles in `max_num`
-    pixel_values = load_image(img_path + f"""/{img_name}""", max_num=6).to(torch.bfloat16).cuda()
-
-    generation_config = dict(
-        num_beams=1,
-        max_new_tokens=1024,
-        do_sample=False,
-    )
 
+def image_hash(image, size=8):
+    # Difference hash of the image, near-identical images (rescaled, recompressed) differ in only a few bits
+    gray = image.convert("L").resize((size + 1, size), Image.LANCZOS)
+    pixels = list(gray.getdata())
+    bits = 0
+    for row in range(size):
+        for col in range(size):
+            bits = (bits << 1) | (pixels[row * (size + 1) + col] > pixels[row * (size + 1) + col + 1])
+    return bits
+
+def filter_images(img_path, min_size=50, min_entropy=2.0, max_distance=5):
+    # Return the extracted images worth captioning, grouped by near-duplicates, the first name of each group is captioned
+    # Tiny decorations and flat images (low entropy, e.g. rules and blank boxes) are dropped,
+    # logos, headers and watermarks repeated on every page collapse into one group
+    groups = []
+    hashes = []
+    for img_name in sorted(os.listdir(img_path)):
+        with Image.open(os.path.join(img_path, img_name)) as image:
+            if min(image.size) < min_size or image.convert("L").entropy() < min_entropy:
+                print(f"Skipping image: {img_name}")
+                continue
+            img_hash = image_hash(image)
+        for i, existing in enumerate(hashes):
+            if bin(img_hash ^ existing).count("1") <= max_distance:
+                groups[i].append(img_name)
+                break
+        else:
+            hashes.append(img_hash)
+            groups.append([img_name])
+    return groups
+
+IMAGENET_MEAN = (0.485, 0.456, 0.406)
+IMAGENET_STD = (0.229, 0.224, 0.225)
+
+def build_transform(input_size):
+    MEAN, STD = IMAGENET_MEAN, IMAGENET_STD
+    transform = T.Compose([
+        T.Lambda(lambda img: img.convert('RGB') if img.mode != 'RGB' else img),
+        T.Resize((input_size, input_size), interpolation=InterpolationMode.BICUBIC),
+        T.ToTensor(),
+        T.Normalize(mean=MEAN, std=STD)
+    ])
+    return transform
+
+def find_closest_aspect_ratio(aspect_ratio, target_ratios, width, height, image_size):
+    best_ratio_diff = float('inf')
+    best_ratio = (1, 1)
+    area = width * height
+    for ratio in target_ratios:
+        target_aspect_ratio = ratio[0] / ratio[1]
+        ratio_diff = abs(aspect_ratio - target_aspect_ratio)
+        if ratio_diff < best_ratio_diff:
+            best_ratio_diff = ratio_diff
+            best_ratio = ratio
+        elif ratio_diff == best_ratio_diff:
+            if area > 0.5 * image_size * image_size * ratio[0] * ratio[1]:
+                best_ratio = ratio
+    return best_ratio
+
+def dynamic_preprocess(image, min_num=1, max_num=6, image_size=448, use_thumbnail=False):
+    orig_width, orig_height = image.size
+    aspect_ratio = orig_width / orig_height
+
+    # calculate the existing image aspect ratio
+    target_ratios = set(
+        (i, j) for n in range(min_num, max_num + 1) for i in range(1, n + 1) for j in range(1, n + 1) if
+        i * j <= max_num and i * j >= min_num)
+    target_ratios = sorted(target_ratios, key=lambda x: x[0] * x[1])
+
+    # find the closest aspect ratio to the target
+    target_aspect_ratio = find_closest_aspect_ratio(
+        aspect_ratio, target_ratios, orig_width, orig_height, image_size)
+
+    # calculate the target width and height
+    target_width = image_size * target_aspect_ratio[0]
+    target_height = image_size * target_aspect_ratio[1]
+    blocks = target_aspect_ratio[0] * target_aspect_ratio[1]
+
+    # resize the image
+    resized_img = image.resize((target_width, target_height))
+    processed_images = []
+    for i in range(blocks):
+        box = (
+            (i % (target_width // image_size)) * image_size,
+            (i // (target_width // image_size)) * image_size,
+            ((i % (target_width // image_size)) + 1) * image_size,
+            ((i // (target_width // image_size)) + 1) * image_size
+        )
+        # split the image
+        split_img = resized_img.crop(box)
+        processed_images.append(split_img)
+    assert len(processed_images) == blocks
+    if use_thumbnail and len(processed_images) != 1:
+        thumbnail_img = image.resize((image_size, image_size))
+        processed_images.append(thumbnail_img)
+    return processed_images
+
+
+def load_image(image_file, input_size=448, max_num=6):
+    image = Image.open(image_file).convert('RGB')
+    transform = build_transform(input_size=input_size)
+    images = dynamic_preprocess(image, image_size=input_size, use_thumbnail=True, max_num=max_num)
+    pixel_values = [transform(image) for image in images]
+    pixel_values = torch.stack(pixel_values)
+    return pixel_values
+
+
+class CaptionEngine:
+    # Keeps InternVL2 resident in the worker process and captions images in batches
+    # Runs on the GPU when there is one, otherwise on the CPU in float32 (or bfloat16 with VISION_CPU_DTYPE=bfloat16)
     prompt = """Analysis the image in detail. Pay extra attentions to graphs, such as bar plots.
                 Return a concise and informative description.
              """
 
-    question = f"""<image>\n{prompt}."""
-    response = model.chat(tokenizer, pixel_values, question, generation_config)
-    # clear model buffer
-    gc.collect()
-    torch.cuda.empty_cache()
-    del model
-    if tokenizer:
-        del tokenizer
+    def __init__(self, model_id="OpenGVLab/InternVL2-4B", device=None, dtype=None, max_num=6, batch_size=4):
+        self.model_id = model_id
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        if dtype is None:
+            dtype = torch.bfloat16 if self.device == "cuda" else getattr(torch, os.environ.get("VISION_CPU_DTYPE", "float32"))
+        self.dtype = dtype
+        # set the max number of tiles in `max_num`
+        self.max_num = max_num
+        self.batch_size = batch_size
+        self.model = None
+        self.tokenizer = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        # Download and load the model on first use only
+        if self.model is None:
+            HUGGINGFACE_KEY = os.environ.get("HUGGINGFACE_KEY")
+            snapshot_download(repo_id=self.model_id, token=HUGGINGFACE_KEY)
+            self.model = AutoModel.from_pretrained(
+                self.model_id,
+                torch_dtype=self.dtype,
+                low_cpu_mem_usage=True,
+                use_flash_attn=self.device == "cuda",
+                trust_remote_code=True).eval().to(self.device)
+            self.tokenizer = AutoTokenizer.from_pretrained(self.model_id, trust_remote_code=True)
+        return self.model, self.tokenizer
+
+    def caption(self, img_files):
+        # Return the description of each image, the tiles of up to `batch_size` images go through one batched forward pass
+        generation_config = dict(
+            num_beams=1,
+            max_new_tokens=1024,
+            do_sample=False,
+        )
+        question = f"""<image>\n{self.prompt}."""
+        responses = []
+        with self.lock:
+            model, tokenizer = self.load()
+            for start in range(0, len(img_files), self.batch_size):
+                batch = img_files[start:start + self.batch_size]
+                began = time.time()
+                pixel_values = [load_image(img_file, max_num=self.max_num) for img_file in batch]
+                num_patches_list = [values.size(0) for values in pixel_values]
+                pixel_values = torch.cat(pixel_values).to(self.dtype).to(self.device)
+                with torch.inference_mode():
+                    responses += model.batch_chat(tokenizer, pixel_values, num_patches_list=num_patches_list,
+                                                  questions=[question] * len(batch), generation_config=generation_config)
+                # The batch is one forward pass, images have no latency of their own, report the batch time and its average
+                elapsed = time.time() - began
+                names = ", ".join(os.path.basename(img_file) for img_file in batch)
+                print(f"Captioned batch of {len(batch)} ({names}) in {elapsed:.2f}s, "
+                      f"{elapsed / len(batch):.2f}s/image batch average ({self.device})")
+        return responses
+
+    def unload(self):
+        # clear model buffer
+        with self.lock:
+            self.model = None
+            self.tokenizer = None
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+
+engine = CaptionEngine()
+
+def image_responses(img_path, img_names):
+    return engine.caption([os.path.join(img_path, img_name) for img_name in img_names])
 
-    return response
\ No newline at end of file
+def image_response(img_path, img_name):
+    return image_responses(img_path, [img_name])[0]
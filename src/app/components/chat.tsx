@@ -3,6 +3,7 @@
 import Button from '@mui/material/Button';
 import { useRef, useEffect, useState } from 'react'
 import axios from 'axios';
+import { waitForTask, streamTask } from '@/lib/utils';
 import { TextField } from '@mui/material';
 import {Box} from "@mui/material";
 import { styled } from '@mui/material/styles';
@@ -18,6 +19,7 @@ interface Message {
     type?: 'text' | 'gif';
     src?: string;
     buttons?: { label: string, onClick: () => void, disabled?: boolean }[];
+    streaming?: boolean;
 }
 
 interface ChatProps {
@@ -146,22 +148,31 @@ const Chat: React.FC<ChatProps> = ({ token }) => {
 
             setTaskID(res.data['task_id']);
 
-            const result = await axios.get('http://localhost:8080/get_task_result',
-                {
-                    params: {
-                        taskID: res.data['task_id'],
-                        taskName: 'get_msg'
-                    },
-                    headers: {
-                        'Authorization': `Bearer ${token}`
+            // Show the answer as it is written, in place of the loading gif
+            const stream = streamTask(res.data['task_id'], res.data['stream_token'], {
+                token: (text: string) => setResponse((prevMessages) => {
+                    const index = prevMessages.findIndex(message => message.streaming);
+                    if (index !== -1) {
+                        const streamed = { ...prevMessages[index], text: prevMessages[index].text + text };
+                        return [...prevMessages.slice(0, index), streamed, ...prevMessages.slice(index + 1)];
                     }
-                }
-            );
+                    const gif = prevMessages.findIndex(message => message.type === 'gif');
+                    const streamed: Message = { sender: 'bot', text: text, streaming: true };
+                    return gif !== -1 ? [...prevMessages.slice(0, gif), streamed, ...prevMessages.slice(gif + 1)] : [...prevMessages, streamed];
+                })
+            });
+
+            let result;
+            try {
+                result = await waitForTask(res.data['task_id'], 'get_msg', token);
+            } finally {
+                stream.close();
+            }
 
             setFetching(false);
-            // Remove the first loading gif from the response
+            // Remove the loading gif or the streamed answer, the final answer replaces it
             setResponse((prevMessages) => {
-                const index = prevMessages.findIndex(message => message.type === 'gif');
+                const index = prevMessages.findIndex(message => message.type === 'gif' || message.streaming);
                 if (index !== -1) {
                     return [
                         ...prevMessages.slice(0, index),
@@ -3,6 +3,7 @@
 import { Button, Dialog, DialogActions, DialogContent, DialogTitle, Box, Checkbox, TextField, Tab } from "@mui/material";
 import { useEffect, useState } from 'react'
 import axios from 'axios';
+import { waitForTask, streamTask } from '@/lib/utils';
 import { pdfjs, Document, Page } from 'react-pdf';
 import PDFView from "./view";
 import Report from "./report";
@@ -43,7 +44,7 @@ const Dpia: React.FC<DpiaProps> = ({ email, token, title, description, projectID
     const [selectedDoc, setSelectedDoc] = useState<string | null>(null);
     const [selectedDocName, setSelectedDocName] = useState<string | null>('');
 
-    const [dpias, setDpias] = useState<{ dpiaID: number; title: string; status: string, tempName: string }[]>([]);
+    const [dpias, setDpias] = useState<{ dpiaID: number; title: string; status: string, running: boolean, tempName: string }[]>([]);
     const [selectedDocs, setSelectedDocs] = useState<number[]>([]);
     const [selectedNames, setSelectedNames] = useState<string[]>([]);
     const [selectedStatus, setSelectedStatus] = useState<string[]>([]);
@@ -51,8 +52,9 @@ const Dpia: React.FC<DpiaProps> = ({ email, token, title, description, projectID
 
     const [openGenerate, setOpenGenerate] = useState<boolean>(false);
     const [dpiaTitle, setDpiaTitle] = useState<string>('');
-    // Check if any dictionary in selectedStatus has status 'working'
-    const isDisabled = dpias.some(item => item.status === 'working');
+    const [progress, setProgress] = useState<string>('');
+    // Check if any DPIA is being generated, a 'working' DPIA that is not running was interrupted and can be resumed
+    const isDisabled = dpias.some(item => item.status === 'working' && item.running);
 
     const filteredDpias = dpias.filter(doc =>
         doc.title.toLowerCase().includes(searchQuery.toLowerCase())
@@ -79,6 +81,46 @@ const Dpia: React.FC<DpiaProps> = ({ email, token, title, description, projectID
         setOpenGenerate(false);
     };
 
+    // generate a DPIA, or resume an interrupted one from its saved sections
+    const runDpia = async (dpiaID: number) => {
+        const res = await axios.post('http://localhost:8080/start_task', {
+            dpiaID: dpiaID,
+            taskName: 'generate_dpia'
+        }, {
+            headers: {
+                'Authorization': `Bearer ${token}`
+            }
+        });
+
+        setTaskID(res.data['task_id']);
+        fetchDpias();
+
+        // Report ingestion and every section as soon as it is written
+        setProgress('');
+        const stream = streamTask(res.data['task_id'], res.data['stream_token'], {
+            progress: (info: any) => info.file && setProgress(`${info.file}: ${info.stage}`),
+            section: (info: any) => setProgress(`${info.completed}/${info.total} sections written, last: ${info.section}`)
+        });
+
+        let generate;
+        try {
+            generate = await waitForTask(res.data['task_id'], 'generate_dpia', token);
+        } finally {
+            stream.close();
+            setProgress('');
+        }
+
+        if (generate) {
+            const resToken = await axios.post('http://localhost:8080/refresh_token',{email: email});
+            if (resToken.data.access_token) {
+              token = resToken.data.access_token;
+            }
+
+            fetchDpias();
+            setTaskID('');
+        }
+    };
+
     const handleDpiaStart = async () => {
 
         setMessage('');
@@ -92,55 +134,29 @@ const Dpia: React.FC<DpiaProps> = ({ email, token, title, description, projectID
                     'Authorization': `Bearer ${token}`
                 }
             });
-            fetchDpias();
             const dpiaID = init.data.dpiaID;
             
             try {
                 setOpenGenerate(false);
-                const res = await axios.post('http://localhost:8080/start_task', {
-                    projectID: projectID,
-                    title: dpiaTitle,
-                    fileName: dpiaFileNames,
-                    dpiaID: dpiaID,
-                    taskName: 'generate_dpia'
-                }, {
-                    headers: {
-                        'Authorization': `Bearer ${token}`
-                    }
-                });
-
-                setTaskID(res.data['task_id']);
-
-                const generate = await axios.get('http://localhost:8080/get_task_result',
-                    {
-                        params: {
-                            taskID: res.data['task_id'],
-                            taskName: 'generate_dpia',
-                        },
-                        headers: {
-                            'Authorization': `Bearer ${token}`
-                        }
-                    } 
-                );
-
-                if (generate) {
-                    const resToken = await axios.post('http://localhost:8080/refresh_token',{email: email});
-                    if (resToken.data.access_token) {
-                      token = resToken.data.access_token;
-                    }
-
-                    fetchDpias();
-                    setTaskID('');
-                }
-             
+                await runDpia(dpiaID);
             } catch (error) {
                 console.error('Error starting DPIA:', error);
+                setMessage(error instanceof Error ? error.message : 'Error starting DPIA');
             }
         } catch (error) {
             console.error('Error starting DPIA:', error);
             setMessage('Check if template and files are selected or filename already exists');
         }
     };
+
+    const handleDpiaResume = async (dpiaID: number) => {
+        try {
+            await runDpia(dpiaID);
+        } catch (error) {
+            console.error('Error resuming DPIA:', error);
+            setMessage(error instanceof Error ? error.message : 'Error resuming DPIA');
+        }
+    };
     
 
     useEffect(() => {
@@ -328,12 +344,14 @@ const Dpia: React.FC<DpiaProps> = ({ email, token, title, description, projectID
                                 primary={doc.title}
                                 secondary={'Template: ' + doc.tempName}
                             />
-                            {doc.status == 'working' && (
+                            {doc.status == 'working' && doc.running && (
                                 <img src='/loading-gif.gif' alt="GIF" style={{width:'30px', height:'30px', marginRight: '15px'}}/>
                             )}
                             <div >
-                                {doc.status == 'working' ? (
-                                    <h1>Processing, please wait...</h1>
+                                {doc.status == 'working' && doc.running ? (
+                                    <h1>{progress || 'Processing, please wait...'}</h1>
+                                ) : doc.status == 'working' ? (
+                                    <Button onClick={() => handleDpiaResume(doc.dpiaID)} variant="contained" color="warning" disabled={isDisabled} style={{ marginRight: '10px' }}>Resume</Button>
                                 ) : (
                                     <Button onClick={() => handleView(doc.dpiaID, doc.title)} variant="contained" color="primary" style={{ marginRight: '10px' }}>View</Button>
                                 )}
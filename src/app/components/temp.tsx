@@ -3,6 +3,7 @@
 import { Button, TextField, Dialog, DialogActions, DialogContent, DialogTitle, MenuItem, Box } from "@mui/material";
 import { useRef, useEffect, useState } from 'react'
 import axios from 'axios';
+import { waitForTask } from '@/lib/utils';
 import Select, { SelectChangeEvent } from '@mui/material/Select';
 import { styled } from '@mui/material/styles';
 import CloudUploadIcon from '@mui/icons-material/CloudUpload';
@@ -123,17 +124,7 @@ const Template: React.FC<TempProps> = ({ token }) => {
 
                 setTaskID(resStart.data['task_id']);
 
-                const result = await axios.get('http://localhost:8080/get_task_result',
-                    {
-                        params: {
-                            taskID: resStart.data['task_id'],
-                            taskName: 'extract_template'
-                        },
-                        headers: {
-                            'Authorization': `Bearer ${token}`
-                        }
-                    }
-                );
+                const result = await waitForTask(resStart.data['task_id'], 'extract_template', token);
 
                 setMessage(result.data['result']);
                 setProcessing(false);
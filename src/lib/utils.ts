@@ -1,6 +1,76 @@
+import axios from "axios"
 import { type ClassValue, clsx } from "clsx"
 import { twMerge } from "tailwind-merge"
 
 export function cn(...inputs: ClassValue[]) {
   return twMerge(clsx(inputs))
 }
+
+/* long-poll the task status until the task has finished, network and server errors are retried with backoff
+   and an expired token is refreshed with the email of the signed-in user */
+export async function waitForTask(taskID: string, taskName: string, token: string | null, maxRetries: number = 8) {
+  const finished = ['SUCCESS', 'FAILURE', 'REVOKED'];
+  let failures = 0;
+  let refreshed = false;
+  while (true) {
+    try {
+      const result = await axios.get('http://localhost:8080/get_task_result',
+        {
+          params: {
+            taskID: taskID,
+            taskName: taskName,
+            wait: 25
+          },
+          headers: {
+            'Authorization': `Bearer ${token}`
+          }
+        }
+      );
+      failures = 0;
+      refreshed = false;
+      if (finished.includes(result.data['state'])) {
+        return result;
+      }
+    } catch (error) {
+      const status = axios.isAxiosError(error) ? error.response?.status : undefined;
+      if (status === 401) {
+        // the access token expires after an hour, long DPIA runs outlive it
+        const email = localStorage.getItem('email');
+        if (refreshed || !email) {
+          throw new Error('Your session has expired, sign in again to see the result of the task');
+        }
+        try {
+          const resToken = await axios.post('http://localhost:8080/refresh_token', { email: email });
+          token = resToken.data.access_token;
+        } catch {
+          throw new Error('Your session has expired, sign in again to see the result of the task');
+        }
+        refreshed = true;
+        continue;
+      }
+      // a request the server rejected will be rejected again, only network and server errors are retried
+      if ((status !== undefined && status < 500) || ++failures > maxRetries) {
+        throw error;
+      }
+      await new Promise((resolve) => setTimeout(resolve, Math.min(1000 * 2 ** (failures - 1), 30000)));
+    }
+  }
+}
+
+/* follow the server-sent events of a task, EventSource cannot send headers so the stream token
+   returned by start_task for this task goes in the query string, it opens a single stream */
+export function streamTask(taskID: string, streamToken: string, handlers: { [event: string]: (data: any) => void }) {
+  const params = new URLSearchParams({ taskID: taskID, token: streamToken });
+  const source = new EventSource(`http://localhost:8080/stream_task?${params}`);
+  for (const event of ['progress', 'section', 'token', 'done', 'error']) {
+    source.addEventListener(event, (message) => {
+      handlers[event]?.(JSON.parse((message as MessageEvent).data));
+      if (event === 'done' || event === 'error') {
+        source.close();
+      }
+    });
+  }
+  // the stream only speeds up output, waitForTask still reports the result if it drops
+  source.onerror = () => source.close();
+  return source;
+}